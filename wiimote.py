@@ -33,9 +33,22 @@
 
 # based on the awesome documentation at http://wiibrew.org/wiki/Wiimote
 
+import array
+import asyncio
+import bisect
 import bluetooth
+import collections
+import heapq
+import math
+import mmap
+import os
+import queue
+import selectors
+import socket
+import struct
 import threading
 import time
+import traceback
 
 # ################### nanosleep ########################### #
 # from https://github.com/graycatlabs/PyBBIO/blob/master/tests/sleep_test.py
@@ -59,7 +72,7 @@ nanosleep_rem = Timespec()
 def nsleep(us):
     """ Delay microseconds with libc nanosleep() using ctypes. """
     if (us >= 1000000):
-        sec = us/1000000
+        sec = int(us // 1000000)
         us %= 1000000
     else:
         sec = 0
@@ -70,6 +83,12 @@ def nsleep(us):
 # ########################################################### #
 
 
+try:
+    import numpy as np  # only required for reading sample histories
+except ImportError:
+    np = None
+
+
 VERSION = (0, 4)
 DEBUG = False
 KNOWN_DEVICES = ['Nintendo RVL-CNT-01', 'Nintendo RVL-CNT-01-TR']
@@ -89,15 +108,17 @@ def find():
     return wiimotes
 
 
-def connect(btaddr, model=None):
+def connect(btaddr, model=None, hub=None):
     """
     Establishes a connection to the Wiimote at *btaddr* and returns a Wiimote
     object. If no *model* is specified, the model is determined automatically.
+    If a *hub* (see `WiiMoteHub`) is given, the Wiimote's reports are received
+    by the hub's thread instead of a thread of its own.
     """
     if model is None:
         model = bluetooth.lookup_name(btaddr)
     if model in KNOWN_DEVICES:
-        return WiiMote(btaddr, model)
+        return WiiMote(btaddr, model, hub)
     else:
         raise Exception("Wiimote model '%s' unknown!" % (model))
 
@@ -136,13 +157,190 @@ def _flatten(list_of_lists):
     return out
 
 
-def _add_padding(byte_list, intended_length, padding_byte=0x00):
+class LatencyStats(object):
     """
-    Pads a list with 0x00's or other padding bytes so that it reaches the intended length.
+    Running statistics (in seconds) for the time between receiving a report
+    from the Wiimote and returning from all callbacks triggered by it.
     """
-    for _ in range(intended_length - len(byte_list)):
-        byte_list.append(padding_byte)
-    return byte_list
+
+    def __init__(self):
+        self.reset()
+
+    def __repr__(self):
+        if self.count == 0:
+            return "<LatencyStats: no reports>"
+        return "<LatencyStats: %d reports, mean %.1f us, min %.1f us, max %.1f us>" % \
+            (self.count, self.mean * 1e6, self.min * 1e6, self.max * 1e6)
+
+    @property
+    def mean(self):
+        return self.total / self.count if self.count else 0.0
+
+    def add(self, latency):
+        self.count += 1
+        self.total += latency
+        self.last = latency
+        if latency < self.min:
+            self.min = latency
+        if latency > self.max:
+            self.max = latency
+
+    def reset(self):
+        self.count = 0
+        self.total = 0.0
+        self.last = 0.0
+        self.min = float('inf')
+        self.max = 0.0
+
+
+class DeviceStats(object):
+    """
+    Running statistics about the reports exchanged with one Wiimote:
+    reports received per type, inter-arrival times and jitter, time spent
+    decoding and in callbacks, receive errors and output reports sent.
+    Times are in seconds. Enable with `WiiMote.enable_stats()`.
+    """
+
+    # upper bounds of the inter-arrival histogram bins,
+    # the last bin counts all longer intervals
+    INTERARRIVAL_BINS = (0.001, 0.002, 0.005, 0.008, 0.012, 0.02, 0.05, 0.1)
+
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.reports = [0] * 256
+        self.interarrival = LatencyStats()
+        self.histogram = [0] * (len(self.INTERARRIVAL_BINS) + 1)
+        self.jitter = 0.0  # smoothed variation of inter-arrival times (RFC 3550)
+        self.decode_time = LatencyStats()  # without callbacks
+        self.callback_time = LatencyStats()
+        self.receive_errors = 0
+        self.reports_sent = 0
+        self.started = time.monotonic()
+        self._last_arrival = None
+
+    def snapshot(self):
+        """
+        Returns the current statistics as a dictionary.
+        """
+        duration = time.monotonic() - self.started
+        received = sum(self.reports)
+        bins = ['<%gms' % (b * 1000) for b in self.INTERARRIVAL_BINS]
+        bins.append('>%gms' % (self.INTERARRIVAL_BINS[-1] * 1000))
+        return {
+            'duration': duration,
+            'reports_received': received,
+            'report_rate': received / duration if duration > 0 else 0.0,
+            'reports': {'0x%02x' % t: n for t, n in enumerate(self.reports) if n},
+            'interarrival': self._summary(self.interarrival),
+            'interarrival_histogram': dict(zip(bins, self.histogram)),
+            'jitter': self.jitter,
+            'decode_time': self._summary(self.decode_time),
+            'callback_time': self._summary(self.callback_time),
+            'receive_errors': self.receive_errors,
+            'reports_sent': self.reports_sent,
+        }
+
+    @staticmethod
+    def _summary(stats):
+        return {'count': stats.count, 'mean': stats.mean,
+                'min': stats.min if stats.count else 0.0, 'max': stats.max}
+
+    def _received(self, rpt_type, received):
+        self.reports[rpt_type] += 1
+        last, self._last_arrival = self._last_arrival, received
+        if last is not None:
+            interval = received - last
+            if self.interarrival.count:
+                self.jitter += (abs(interval - self.interarrival.last) - self.jitter) / 16
+            self.interarrival.add(interval)
+            self.histogram[bisect.bisect_left(self.INTERARRIVAL_BINS, interval)] += 1
+
+    def _call(self, callbacks, arg):
+        start = time.perf_counter()
+        for callback in callbacks:
+            callback(arg)
+        self.callback_time.add(time.perf_counter() - start)
+
+
+class SampleHistory(object):
+    """
+    Fixed-capacity ring buffer of timestamped sensor samples.
+    Receive timestamps (`time.monotonic()`) and values are stored in compact
+    typed arrays. Each sample gets a sequence number (0, 1, 2, ...); once the
+    buffer is full, the oldest samples are overwritten.
+    Reading samples requires NumPy.
+    """
+
+    def __init__(self, width, capacity=1024, typecode='H'):
+        self.width = width
+        self.capacity = capacity
+        self._times = array.array('d', bytes(8 * capacity))
+        self._values = array.array(typecode, [0]) * (width * capacity)
+        self._seq = 0
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return min(self._seq, self.capacity)
+
+    @property
+    def seq(self):
+        """
+        Sequence number of the next sample to be stored.
+        """
+        return self._seq
+
+    def append(self, timestamp, values):
+        """
+        Store a sample consisting of `width` values.
+        Usually gets called by the sensor objects.
+        """
+        with self._lock:
+            idx = self._seq % self.capacity
+            self._times[idx] = timestamp
+            start = idx * self.width
+            for i, val in enumerate(values):
+                self._values[start + i] = val
+            self._seq += 1
+
+    def since(self, seq):
+        """
+        Returns all samples with a sequence number of at least `seq` as a tuple
+        (next_seq, timestamps, values) with NumPy arrays of shape (n,) and
+        (n, width). Pass `next_seq` to the following call to get only new samples.
+        Samples that have already been overwritten are skipped.
+        """
+        with self._lock:
+            end = self._seq
+            times, values = self._copy(max(seq, end - self.capacity, 0), end)
+        return end, times, values
+
+    def last(self, num_samples):
+        """
+        Returns the last `num_samples` samples (or fewer if not yet available)
+        as a tuple (timestamps, values) of NumPy arrays.
+        """
+        with self._lock:
+            end = self._seq
+            return self._copy(max(end - num_samples, end - self.capacity, 0), end)
+
+    def _copy(self, start, end):
+        """
+        Copies samples `start` to `end` out of the ring buffer without touching
+        the rest of the history.
+        """
+        if np is None:
+            raise RuntimeError("NumPy is required for reading sample histories")
+        times = np.frombuffer(self._times, dtype=np.float64)
+        values = np.frombuffer(self._values, dtype=self._values.typecode).reshape(-1, self.width)
+        first = start % self.capacity
+        count = end - start
+        if first + count <= self.capacity:
+            return times[first:first + count].copy(), values[first:first + count].copy()
+        wrapped = first + count - self.capacity
+        return (np.concatenate((times[first:], times[:wrapped])),
+                np.concatenate((values[first:], values[:wrapped])))
 
 
 def _debug(msg):
@@ -154,67 +352,512 @@ def _debug(msg):
         print("DEBUG: " + str(msg))
 
 
+# Layout of all input reports, see http://wiibrew.org/wiki/Wiimote#Data_Reporting
+# For each report type, a tuple of (sensor, decoder, offset, length) entries
+# describes which data the report contains and which method of the
+# corresponding WiiMote attribute decodes it.
+# Offsets are relative to the report ID byte.
+_BTN = ('buttons', '_decode', 1, 2)
+_ACC = ('accelerometer', '_decode', 1, 5)  # uses LSBs from the button bytes
+
+INPUT_REPORTS = {
+    0x20: (_BTN,),  # status
+    0x21: (_BTN, ('memory', '_decode', 3, 19)),  # memory read reply
+    0x22: (_BTN, ('memory', '_decode_ack', 3, 2)),  # acknowledge output report
+    0x30: (_BTN,),
+    0x31: (_BTN, _ACC),
+    0x32: (_BTN, ('extension', '_decode', 3, 8)),
+    0x33: (_BTN, _ACC, ('ir', '_decode_extended', 6, 12)),
+    0x34: (_BTN, ('extension', '_decode', 3, 19)),
+    0x35: (_BTN, _ACC, ('extension', '_decode', 6, 16)),
+    0x36: (_BTN, ('ir', '_decode_basic', 3, 10), ('extension', '_decode', 13, 9)),
+    0x37: (_BTN, _ACC, ('ir', '_decode_basic', 6, 10), ('extension', '_decode', 16, 6)),
+    0x3d: (('extension', '_decode', 1, 21),),
+    # interleaved: each report carries half of the accelerometer and IR data
+    0x3e: (_BTN, ('accelerometer', '_decode_interleaved_a', 1, 3), ('ir', '_decode_full_a', 4, 18)),
+    0x3f: (_BTN, ('accelerometer', '_decode_interleaved_b', 1, 3), ('ir', '_decode_full_b', 4, 18)),
+}
+
+
+def _decode_report(sensor, name, report):
+    """
+    Looks up all data for sensor `name` in `report` (starting with the report
+    ID) and passes it to the respective decoder of `sensor`.
+    """
+    for sensor_name, decoder, offset, length in INPUT_REPORTS.get(report[0], ()):
+        if sensor_name == name:
+            getattr(sensor, decoder)(report, offset, length)
+
+
+# smallest data reporting mode by (accelerometer, IR, extension) in use
+_REPORT_MODES = {
+    (False, False, False): 0x30,
+    (True, False, False): 0x31,
+    (False, False, True): 0x32,
+    (True, False, True): 0x35,
+    (False, True, False): 0x33,
+    (True, True, False): 0x33,
+    (False, True, True): 0x36,
+    (True, True, True): 0x37,
+}
+
+
+# IR data format contained in each reporting mode
+IR_FORMATS = {0x33: 3, 0x36: 1, 0x37: 1, 0x3e: 5, 0x3f: 5}
+
+
+def select_report_mode(accelerometer, ir, extension, ir_mode=3):
+    """
+    Returns the data reporting mode with the fewest bytes per report that
+    contains all requested sensors, with IR data in the format `ir_mode`
+    (see `IRCam`) where possible.
+    Extension data only fits next to basic IR data; full IR data (0x3e/0x3f)
+    leaves no room for the extension.
+    """
+    if ir and ir_mode == IRCam.MODE_FULL:
+        return 0x3e
+    if ir and ir_mode == IRCam.MODE_BASIC:
+        return 0x37 if accelerometer else 0x36
+    return _REPORT_MODES[(bool(accelerometer), bool(ir), bool(extension))]
+
+
+class Subscription(object):
+    """
+    A callback that is called from the worker threads of a `CallbackDispatcher`
+    instead of the thread receiving the reports.
+    Events are buffered in a queue of up to `maxsize` entries. If the queue is
+    full, the subscription's policy decides what happens to a new event:
+    BLOCK waits until there is room again (stalling the receiving thread),
+    DROP_OLDEST discards the oldest queued event, COALESCE keeps only the
+    latest event. Discarded events are counted in `dropped`.
+    """
+
+    BLOCK = 'block'
+    DROP_OLDEST = 'drop_oldest'
+    COALESCE = 'coalesce'
+
+    def __init__(self, dispatcher, func, policy, maxsize):
+        if policy not in (self.BLOCK, self.DROP_OLDEST, self.COALESCE):
+            raise ValueError("Unknown policy '%s'" % policy)
+        self.func = func
+        self.policy = policy
+        self.maxsize = 1 if policy == self.COALESCE else maxsize
+        self.delivered = 0
+        self.dropped = 0
+        self.closed = False
+        self._dispatcher = dispatcher
+        self._events = collections.deque()
+        self._condition = threading.Condition()
+        self._scheduled = False  # queued for a worker or being processed
+
+    def __call__(self, event):
+        with self._condition:
+            if self.closed:
+                return
+            if len(self._events) >= self.maxsize:
+                if self.policy == self.BLOCK:
+                    self._condition.wait_for(
+                        lambda: len(self._events) < self.maxsize or self.closed)
+                    if self.closed:
+                        return
+                else:
+                    self._events.popleft()
+                    self.dropped += 1
+            self._events.append(event)
+            if self._scheduled:
+                return
+            self._scheduled = True
+        self._dispatcher._ready.put(self)
+
+    def close(self):
+        """
+        Stops delivering events and discards all queued ones.
+        """
+        with self._condition:
+            self.closed = True
+            self._events.clear()
+            self._condition.notify_all()
+
+    def _deliver(self):
+        """
+        Calls `func` with the oldest queued event. Runs in a worker thread.
+        Only one worker handles a subscription at a time, so that events are
+        delivered in order.
+        """
+        with self._condition:
+            if not self._events:
+                self._scheduled = False
+                return
+            event = self._events.popleft()
+            self._condition.notify_all()
+        try:
+            self.func(event)
+        except Exception:
+            traceback.print_exc()
+        self.delivered += 1
+        with self._condition:
+            if not self._events:
+                self._scheduled = False
+                return
+        self._dispatcher._ready.put(self)
+
+
+class CallbackDispatcher(object):
+    """
+    Pool of worker threads that call subscribed callbacks, so that slow
+    callbacks do not delay the decoding of incoming reports.
+    See `Subscription` for the available queueing policies.
+    """
+
+    def __init__(self, workers=2):
+        self._ready = queue.Queue()
+        self._subscriptions = []
+        self._workers = []
+        for _ in range(workers):
+            worker = threading.Thread(target=self._work)
+            worker.daemon = True
+            worker.start()
+            self._workers.append(worker)
+
+    def subscribe(self, func, policy=Subscription.DROP_OLDEST, maxsize=64):
+        """
+        Returns a `Subscription` for `func` that can be registered as a callback.
+        """
+        subscription = Subscription(self, func, policy, maxsize)
+        self._subscriptions.append(subscription)
+        return subscription
+
+    def unsubscribe(self, subscription):
+        subscription.close()
+        if subscription in self._subscriptions:
+            self._subscriptions.remove(subscription)
+
+    def stats(self):
+        """
+        Returns a dict with the numbers of delivered and dropped events,
+        in total and for each subscribed callback.
+        """
+        subscriptions = [{'func': sub.func, 'policy': sub.policy, 'queued': len(sub._events),
+                          'delivered': sub.delivered, 'dropped': sub.dropped}
+                         for sub in list(self._subscriptions)]
+        return {'delivered': sum(sub['delivered'] for sub in subscriptions),
+                'dropped': sum(sub['dropped'] for sub in subscriptions),
+                'subscriptions': subscriptions}
+
+    def shutdown(self):
+        """
+        Closes all subscriptions and stops the worker threads.
+        """
+        for subscription in list(self._subscriptions):
+            self.unsubscribe(subscription)
+        for _ in self._workers:
+            self._ready.put(None)
+
+    def _work(self):
+        while True:
+            subscription = self._ready.get()
+            if subscription is None:
+                return
+            subscription._deliver()
+
+
+def _add_callback(callbacks, wiimote, func, policy, maxsize):
+    """
+    Adds `func` to a sensor's list of callbacks. If a policy is given, `func`
+    is called through the Wiimote's `CallbackDispatcher` instead.
+    """
+    if policy is not None:
+        func = wiimote.get_dispatcher().subscribe(func, policy, maxsize)
+    callbacks.append(func)
+
+
+def _auto_enable(sensor):
+    """
+    Enables `sensor` when its values are read for the first time.
+    Reading never raises because of the Wiimote: errors are only logged
+    and enabling is tried again on the next read.
+    """
+    try:
+        sensor.enable()
+    except (RuntimeError, OSError) as e:
+        _debug("Could not enable %s: %s" % (type(sensor).__name__, e))
+
+
+def _update_or_undo(wiimote, undo):
+    """
+    Updates the report mode after a sensor has been put in use. If that
+    fails, `undo()` takes the change back before the error is raised.
+    """
+    try:
+        wiimote._update_report_mode()
+    except BaseException:
+        undo()
+        raise
+
+
+def _remove_callback(callbacks, func):
+    for callback in list(callbacks):
+        if callback == func or getattr(callback, 'func', None) == func:
+            callbacks.remove(callback)
+            if isinstance(callback, Subscription):
+                callback._dispatcher.unsubscribe(callback)
+
+
+class AccelerometerCalibration(object):
+    """
+    Zero-point and 1 g readings of all three accelerometer axes, as stored
+    in the Wiimote's EEPROM, see http://wiibrew.org/wiki/Wiimote#EEPROM_Memory
+    """
+
+    EEPROM_ADDRESS = 0x16
+    EEPROM_SIZE = 10
+
+    def __init__(self, zero, one_g):
+        self.zero = tuple(zero)
+        self.one_g = tuple(one_g)
+        if 0 in [g - z for g, z in zip(self.one_g, self.zero)]:
+            raise ValueError("Invalid calibration: zero point equals 1 g reading")
+
+    def __repr__(self):
+        return "<AccelerometerCalibration zero=%r one_g=%r>" % (self.zero, self.one_g)
+
+    @classmethod
+    def from_eeprom(cls, data):
+        """
+        Parses the 10-byte calibration block read from `EEPROM_ADDRESS`.
+        """
+        if len(data) != cls.EEPROM_SIZE:
+            raise ValueError("Calibration data needs to be %d bytes long" % cls.EEPROM_SIZE)
+        if (sum(data[:9]) + 0x55) & 0xff != data[9]:
+            _debug("Checksum mismatch in accelerometer calibration data")
+
+        def ten_bits(block):
+            # three MSB bytes, followed by a byte with the two LSBs of each axis
+            lsbs = block[3]
+            return ((block[0] << 2) + ((lsbs >> 4) & 0b11),
+                    (block[1] << 2) + ((lsbs >> 2) & 0b11),
+                    (block[2] << 2) + (lsbs & 0b11))
+        return cls(ten_bits(data[0:4]), ten_bits(data[4:8]))
+
+    def to_g(self, values):
+        """
+        Converts a single raw (x, y, z) sample into acceleration in g.
+        """
+        return [(val - z) / (g - z) for val, z, g in zip(values, self.zero, self.one_g)]
+
+    def to_g_array(self, values):
+        """
+        Converts a batch of raw samples (anything that can be turned into a
+        NumPy array of shape (..., 3), e.g. `SampleHistory` values) into
+        acceleration in g with a single vectorized operation.
+        """
+        if np is None:
+            raise RuntimeError("NumPy is required for batch conversion")
+        zero = np.array(self.zero, dtype=np.float64)
+        scale = 1.0 / (np.array(self.one_g, dtype=np.float64) - zero)
+        return (np.asarray(values, dtype=np.float64) - zero) * scale
+
+
+# accelerometer calibration data read from the EEPROM, by Bluetooth address
+_calibrations = {}
+
+
 class Accelerometer(object):
     """
     Represents the accelerometer of the Wiimote.
     """
 
-    SUPPORTED_REPORTS = [0x31, 0x33]
-
     def __init__(self, wiimote):
-        self._state = [0.0, 0.0, 0.0]
+        self._state = [0, 0, 0]
         self._wiimote = wiimote
         self._com = wiimote._com
         self._callbacks = []
+        self._enabled = False
+        self._raw = None  # (parser, data) stored by _store() in lazy decoding mode
+        self._decoded = None
+        self._partial = None  # first half of an interleaved report pair
+        self.history = None
+        self.calibration = None
 
     def __len__(self):
         return len(self._state)
 
     def __repr__(self):
-        return repr(self._state)
+        return repr(self._load())
 
     def __getitem__(self, axis):
+        if not self._enabled:
+            _auto_enable(self)
         if 0 <= axis <= 2:
-            return self._state[axis]
+            return self._load()[axis]
         else:
             raise IndexError("list index %d out of range" % (axis))
 
-    def register_callback(self, func):
+    @property
+    def g(self):
+        """
+        Current acceleration on all three axes in g (requires calibration data).
+        """
+        if self.calibration is None:
+            raise RuntimeError("No calibration data available")
+        if not self._enabled:
+            _auto_enable(self)
+        return self.calibration.to_g(self._load())
+
+    def load_calibration(self, timeout=1.0):
+        """
+        Reads the calibration data from the Wiimote's EEPROM into
+        `self.calibration`. The data is read only once per device and
+        cached afterwards.
+        """
+        btaddr = self._wiimote.btaddr
+        if btaddr not in _calibrations:
+            data = self._wiimote.memory.read(AccelerometerCalibration.EEPROM_ADDRESS,
+                                             AccelerometerCalibration.EEPROM_SIZE,
+                                             eeprom=True, timeout=timeout)
+            _calibrations[btaddr] = AccelerometerCalibration.from_eeprom(data)
+        self.calibration = _calibrations[btaddr]
+        return self.calibration
+
+    def enable(self):
+        """
+        Request accelerometer data from the Wiimote.
+        Happens automatically when values are read, when registering a
+        callback, or when enabling the history.
+        """
+        self._enabled = True
+        _update_or_undo(self._wiimote, self._undo_enable)
+
+    def _undo_enable(self):
+        self._enabled = False
+
+    def disable(self):
+        """
+        Stop requesting accelerometer data unless callbacks or a history need it.
+        """
+        self._enabled = False
+        self._wiimote._update_report_mode()
+
+    def in_use(self):
+        return self._enabled or bool(self._callbacks) or self.history is not None
+
+    def _needs_decoding(self):
+        return bool(self._callbacks) or self.history is not None
+
+    def enable_history(self, capacity=1024):
+        """
+        Keep the last `capacity` accelerometer samples with timestamps in
+        `self.history` (see `SampleHistory`), e.g. for consumers that poll
+        less often than the Wiimote sends reports.
+        """
+        self.history = SampleHistory(3, capacity)
+        _update_or_undo(self._wiimote, self._undo_history)
+
+    def disable_history(self):
+        self.history = None
+        self._wiimote._update_report_mode()
+
+    def _undo_history(self):
+        self.history = None
+
+    def register_callback(self, func, policy=None, maxsize=64):
         """
         Register a callback function `func` that gets called every time
         when new accelerometer values are transmitted from the Wiimote.
         A list with XYZ accelerometer values between 0 and 1023 is passed
         to the callback function.
+        If `policy` is given (see `Subscription`), `func` is called from a
+        worker thread of the Wiimote's `CallbackDispatcher` with up to
+        `maxsize` events queued.
         """
-        self._callbacks.append(func)
+        _add_callback(self._callbacks, self._wiimote, func, policy, maxsize)
+        _update_or_undo(self._wiimote, lambda: _remove_callback(self._callbacks, func))
 
     def unregister_callback(self, func):
         """
         Unregister a callback function `func` that has been previously registered.
         The function will no longer get called on new accelerometer data from the Wiimote.
         """
-        if func in self._callbacks:
-            self._callbacks.remove(func)
+        _remove_callback(self._callbacks, func)
+        self._wiimote._update_report_mode()
 
     def _notify_callbacks(self):
         """
         Call all registered callback functions with state (x,y,z values) as parameter.
         """
+        stats = self._com.stats
+        if stats is not None:
+            stats._call(self._callbacks, self._state)
+            return
         for callback in self._callbacks:
             callback(self._state)
 
     def handle_report(self, report):
         """
         Extract accelerometer data from a Wiimote report.
+        """
+        _decode_report(self, 'accelerometer', report)
+
+    @staticmethod
+    def _parse(report, offset):
+        """
+        Returns the accelerometer values starting at the button bytes at `offset`.
+        """
+        x = (report[offset + 2] << 2) + ((report[offset] & 0b01100000) >> 5)
+        y = (report[offset + 3] << 2) + ((report[offset + 1] & 0b00100000) >> 4)
+        z = (report[offset + 4] << 2) + ((report[offset + 1] & 0b01000000) >> 5)
+        return [x, y, z]
+
+    def _store(self, report, offset, length):
+        """
+        Keeps a copy of the raw data for decoding on access (lazy decoding mode).
+        """
+        self._raw = (self._parse, bytes(report[offset:offset + length]))
+
+    def _load(self):
+        """
+        Returns the current state, decoding the latest raw data first if necessary.
+        """
+        raw = self._raw
+        if raw is not self._decoded:
+            self._state = raw[0](raw[1], 0)
+            self._decoded = raw
+        return self._state
+
+    def _decode(self, report, offset, length):
+        """
+        Decode accelerometer data starting at the button bytes at `offset`.
         Usually gets called by the Wiimote CommunicationHandler object.
         """
-        if report[0] in [0x3e, 0x3f]:  # interleaved modes
-            raise NotImplementedError("Data reporting mode 0x3e/0x3f not supported")
-        x_msb, y_msb, z_msb = report[3:6]
-        x = (x_msb << 2) + ((report[1] & 0b01100000) >> 5)
-        y = (y_msb << 2) + ((report[2] & 0b00100000) >> 4)
-        z = (z_msb << 2) + ((report[2] & 0b01000000) >> 5)
-        self._state = [x, y, z]
+        self._state = self._parse(report, offset)
+        self._raw = self._decoded = None
+        if self.history is not None:
+            self.history.append(self._com.report_time, self._state)
+        self._notify_callbacks()
+
+    def _decode_interleaved_a(self, report, offset, length):
+        """
+        Keep X and the upper half of Z from report 0x3e until report 0x3f follows.
+        Z is spread over the otherwise unused bits 5 and 6 of both button bytes.
+        """
+        self._partial = (report[offset + 2],
+                         ((report[offset] & 0x60) >> 1) | ((report[offset + 1] & 0x60) << 1))
+
+    def _decode_interleaved_b(self, report, offset, length):
+        """
+        Complete the sample with Y and the lower half of Z from report 0x3f.
+        Interleaved reports carry 8 bits per axis, which are scaled to the
+        10-bit range of the other reporting modes.
+        """
+        partial, self._partial = self._partial, None
+        if partial is None:  # first half got lost
+            return
+        x, z = partial
+        z |= ((report[offset] & 0x60) >> 5) | ((report[offset + 1] & 0x60) >> 3)
+        self._state = [x << 2, report[offset + 2] << 2, z << 2]
+        self._raw = self._decoded = None
+        if self.history is not None:
+            self.history.append(self._com.report_time, self._state)
         self._notify_callbacks()
 
 
@@ -235,69 +878,93 @@ class Buttons(object):
                'Two': 0x0001,
                'Up': 0x0800, }
 
+    ALL_BUTTONS = 0x1f9f  # the other bits carry accelerometer data
+    _NAMES = dict((mask, btn) for btn, mask in BUTTONS.items())
+
     def __init__(self, wiimote):
         self._wiimote = wiimote
         self._com = wiimote._com
-        self._state = {}
-        for button in list(Buttons.BUTTONS.keys()):
-            self._state[button] = False
+        self._mask = 0
         self._callbacks = []
 
     def __len__(self):
-        return len(self._state)
+        return len(Buttons.BUTTONS)
 
     def __repr__(self):
-        return repr(self._state)
+        return repr(self.get_state())
 
     def __getitem__(self, btn):
-        if btn in self._state:
-            return self._state[btn]
+        if btn in Buttons.BUTTONS:
+            return bool(self._mask & Buttons.BUTTONS[btn])
         else:
             raise KeyError(str(btn))
 
-    def register_callback(self, func):
+    @property
+    def mask(self):
+        """
+        Current state of all buttons as an integer bitmask (see `Buttons.BUTTONS`).
+        """
+        return self._mask
+
+    def get_state(self):
+        """
+        Returns a dictionary mapping each button name to its state.
+        """
+        return dict((btn, bool(self._mask & mask)) for btn, mask in Buttons.BUTTONS.items())
+
+    def register_callback(self, func, policy=None, maxsize=64):
         """
         Register a callback function `func` that gets called every time
-        when new button states are transmitted from the Wiimote.
-        A list of all _changed_ buttons is passed as parameter to this function.
+        the state of one or more buttons changes.
+        A list of (button, state) tuples for all _changed_ buttons is passed
+        as parameter to this function.
+        If `policy` is given (see `Subscription`), `func` is called from a
+        worker thread of the Wiimote's `CallbackDispatcher` with up to
+        `maxsize` events queued.
         """
-        self._callbacks.append(func)
+        _add_callback(self._callbacks, self._wiimote, func, policy, maxsize)
 
     def unregister_callback(self, func):
         """
         Unregister a callback function `func` that has been previously registered.
         The function will no longer get called on changed button states.
         """
-        if func in self._callbacks:
-            self._callbacks.remove(func)
+        _remove_callback(self._callbacks, func)
 
     def _notify_callbacks(self, diff):
         """
         Call all registered callback functions with a list of buttons whose state
         has changed as parameter.
         """
+        stats = self._com.stats
+        if stats is not None:
+            stats._call(self._callbacks, diff)
+            return
         for callback in self._callbacks:
             callback(diff)
 
     def handle_report(self, report):
         """
         Extract button data from a Wiimote report.
-        Usually gets called by the Wiimote CommunicationHandler object.
         """
-        btn_bytes = (report[1] << 8) + report[2]
-        new_state = {}
-        for btn, mask in list(Buttons.BUTTONS.items()):
-            new_state[btn] = bool(mask & btn_bytes)
-        diff = self._update_state(new_state)
-        self._notify_callbacks(diff)
+        _decode_report(self, 'buttons', report)
 
-    def _update_state(self, new_state):
+    def _decode(self, report, offset, length):
+        """
+        Decode the two button bytes at `offset`.
+        Usually gets called by the Wiimote CommunicationHandler object.
+        """
+        mask = ((report[offset] << 8) + report[offset + 1]) & Buttons.ALL_BUTTONS
+        changed = mask ^ self._mask
+        if not changed:
+            return
+        self._mask = mask
         diff = []
-        for btn, state in list(new_state.items()):
-            if self._state[btn] != state:
-                diff.append((btn, state))
-                self._state[btn] = state
-        return diff
+        while changed:
+            bit = changed & -changed  # lowest changed bit
+            diff.append((Buttons._NAMES[bit], bool(mask & bit)))
+            changed ^= bit
+        self._notify_callbacks(diff)
 
 
 class LEDs(object):
@@ -308,6 +975,7 @@ class LEDs(object):
     def __init__(self, wiimote):
         self._state = [False, False, False, False]
         self._com = wiimote._com
+        self._lock = threading.Lock()
 
     def __len__(self):
         return len(self._state)
@@ -322,10 +990,11 @@ class LEDs(object):
             raise IndexError("list index out of range")
 
     def __setitem__(self, led_no, val):
-        new_led_state = self._state
         if 0 <= led_no <= 3:
-            new_led_state[led_no] = True if val else False
-            self.set_leds(new_led_state)
+            with self._lock:
+                new_led_state = list(self._state)
+                new_led_state[led_no] = True if val else False
+                self._set(new_led_state)
         else:
             raise IndexError("list index out of range")
 
@@ -334,23 +1003,178 @@ class LEDs(object):
         Set leds 1-4.
         led_list: list of four boolean values representing the states of the LEDs
         """
-        for led_no, val in enumerate(led_list):
-            self._state[led_no] = True if val else False
-        RPT_LED = 0x11
+        with self._lock:
+            self._set([True if val else False for val in led_list])
+
+    def _set(self, new_led_state):
+        # readers may hold a reference to the old list, so never change it
+        self._state = new_led_state
         led_byte = 0x00
-        for val, state in zip([0x10, 0x20, 0x40, 0x80], self._state):
+        for val, state in zip([0x10, 0x20, 0x40, 0x80], new_led_state):
             if state:
                 led_byte += val
-        self._com._send(RPT_LED, led_byte)
+        self._com.send_leds(led_byte)
+
+
+class RumblePattern(object):
+    """
+    A rumble pattern played by the `RumbleScheduler`.
+    `durations` alternate between on and off phases (in seconds), starting
+    with an on phase. The sequence is played `repeat` times, or until
+    cancel() is called if `repeat` is None.
+    Returned by `Rumbler.play()`.
+    """
+
+    def __init__(self, rumbler, durations, repeat=1):
+        if not durations or min(durations) <= 0:
+            raise ValueError("durations need to be a non-empty list of positive numbers")
+        if repeat is not None and repeat < 1:
+            raise ValueError("repeat needs to be at least 1 or None")
+        self.rumbler = rumbler
+        self.durations = list(durations)
+        self.repeat = repeat
+        self.on = False
+        self._step = -1
+        self._loop = 0
+        self._deadline = 0.0
+        self._finished = threading.Event()
+
+    def cancel(self):
+        """
+        Stops the pattern. The motor keeps running if another pattern or
+        `Rumbler.set_rumble()` wants it on.
+        """
+        _get_rumble_scheduler().cancel(self)
+
+    def done(self):
+        return self._finished.is_set()
+
+    def wait(self, timeout=None):
+        """
+        Blocks until the pattern has finished or was cancelled.
+        Returns False if `timeout` seconds passed before.
+        """
+        return self._finished.wait(timeout)
+
+    def _advance(self):
+        """
+        Switches to the next phase and returns its duration,
+        or None if the pattern is finished.
+        """
+        self._step += 1
+        if self._step == len(self.durations):
+            self._step = 0
+            self._loop += 1
+            if self.repeat is not None and self._loop == self.repeat:
+                self.on = False
+                return None
+        self.on = self._step % 2 == 0
+        return self.durations[self._step]
+
+
+class RumbleScheduler(threading.Thread):
+    """
+    Plays the rumble patterns of all Wiimotes from a single thread.
+    Phase changes are kept in a heap ordered by deadline, and each deadline
+    is computed from the previous one, so long patterns do not drift.
+    Use the shared instance returned by `_get_rumble_scheduler()`.
+    """
+
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._heap = []
+        self._counter = 0  # keeps heap entries with equal deadlines comparable
+        self._cond = threading.Condition()
+
+    def add(self, pattern):
+        changed = set()
+        with self._cond:
+            pattern._deadline = time.monotonic()
+            pattern.rumbler._patterns.add(pattern)
+            self._step(pattern, changed)
+            self._cond.notify()
+        _send_rumble(changed)
+
+    def cancel(self, pattern):
+        changed = set()
+        with self._cond:
+            # the heap entry is skipped once it becomes due
+            self._finish(pattern, changed)
+        _send_rumble(changed)
+
+    def run(self):
+        heap = self._heap
+        while True:
+            changed = set()
+            with self._cond:
+                while not heap:
+                    self._cond.wait()
+                now = time.monotonic()
+                if heap[0][0] > now:
+                    self._cond.wait(heap[0][0] - now)
+                    continue
+                while heap and heap[0][0] <= now:
+                    pattern = heapq.heappop(heap)[2]
+                    if pattern in pattern.rumbler._patterns:
+                        self._step(pattern, changed)
+            # send outside the lock, so a slow link does not delay other Wiimotes
+            _send_rumble(changed)
+
+    def _step(self, pattern, changed):
+        """
+        Advances `pattern` to its next phase and updates the motor state.
+        Rumblers whose motor state changed are added to `changed`.
+        Needs to be called with `_cond` held.
+        """
+        duration = pattern._advance()
+        if duration is None:
+            self._finish(pattern, changed)
+            return
+        pattern._deadline += duration
+        self._counter += 1
+        heapq.heappush(self._heap, (pattern._deadline, self._counter, pattern))
+        if pattern.rumbler._update():
+            changed.add(pattern.rumbler)
+
+    def _finish(self, pattern, changed):
+        pattern.on = False
+        pattern.rumbler._patterns.discard(pattern)
+        if pattern.rumbler._update():
+            changed.add(pattern.rumbler)
+        pattern._finished.set()
+
+
+def _send_rumble(rumblers):
+    for rumbler in rumblers:
+        rumbler._send()
+
+
+_rumble_scheduler = None
+_rumble_scheduler_lock = threading.Lock()
+
+
+def _get_rumble_scheduler():
+    global _rumble_scheduler
+    with _rumble_scheduler_lock:
+        if _rumble_scheduler is None:
+            _rumble_scheduler = RumbleScheduler()
+            _rumble_scheduler.start()
+        return _rumble_scheduler
 
 
 class Rumbler(object):
     """
     Represents the rumble motor of the Wiimote.
+    The motor is on while set_rumble(True) is in effect or any pattern
+    started with play() or rumble() is in an on phase.
     """
 
     def __init__(self, wiimote):
         self._state = False
+        self._motor = False
+        self._patterns = set()
+        self._send_lock = threading.Lock()
         self.wiimote = wiimote
 
     def set_rumble(self, state):
@@ -358,330 +1182,2305 @@ class Rumbler(object):
         Activate or deactivate the rumble motor.
         state: True or False
         """
-        self._state = state
-        self.wiimote._com.set_rumble(state)
+        with _get_rumble_scheduler()._cond:
+            self._state = bool(state)
+            self._update()
+        self._send()
 
     def rumble(self, length=0.5):
         """
         Activate the rumble motor for `length` seconds.
+        Returns the `RumblePattern`.
         """
-        t = threading.Timer(length, self.set_rumble, [False])
-        t.start()
-        self.set_rumble(True)
-
+        return self.play([length])
 
-class Speaker(object):
-    """
-    Represents the speaker of the Wiimote.
-    """
+    def play(self, durations, repeat=1):
+        """
+        Plays a sequence of on/off `durations` (in seconds, starting with on)
+        `repeat` times, or until cancelled if `repeat` is None.
+        Returns a `RumblePattern` that can be cancelled or waited for.
+        Example: `wm.rumbler.play([0.1, 0.05], repeat=3)`
+        """
+        pattern = RumblePattern(self, durations, repeat)
+        _get_rumble_scheduler().add(pattern)
+        return pattern
 
-    def __init__(self, wiimote):
-        self._playing = False
-        self.wiimote = wiimote
-        self._com = wiimote._com
+    def cancel(self):
+        """
+        Stops all patterns of this Wiimote.
+        """
+        scheduler = _get_rumble_scheduler()
+        changed = set()
+        with scheduler._cond:
+            for pattern in list(self._patterns):
+                scheduler._finish(pattern, changed)
+        _send_rumble(changed)
+
+    def _update(self):
+        """
+        Merges manual state and patterns into the motor state.
+        Returns True if it changed and needs to be sent with _send().
+        Needs to be called with the scheduler's `_cond` held.
+        """
+        motor = self._state or any(p.on for p in self._patterns)
+        changed = motor != self._motor
+        self._motor = motor
+        return changed
 
-    def beep(self):
+    def _send(self):
         """
-        Play a short beep through the speaker
+        Sends the motor state. Called without the scheduler's lock held;
+        always sends the latest state, so concurrent sends cannot leave
+        the motor in an outdated state.
         """
-        if self._playing:
-            return
-        self._playing = True
-        RPT_SPKR_ON = 0x14
-        RPT_SPKR_MUTE = 0x19
-        RPT_SPKR_PLAY = 0x18
-        ON = 0x04
-        OFF = 0x00
-        self._com._send(RPT_SPKR_ON, ON)
-        self._com._send(RPT_SPKR_MUTE, ON)
-        # Write 0x01 to register 0xa20009
-        self.wiimote.memory.write(0xa20009, [0x01])
-        # Write 0x08 to register 0xa20001
-        self.wiimote.memory.write(0xa20001, [0x08])
-        # set up for 8-Bit PCM, 1000 Hz, see http://wiibrew.org/wiki/Wiimote#Speaker
-        self.wiimote.memory.write(0xa20001, [0x00, 0x40, 0x70, 0x17, 0x30, 0x00, 0x00])
-        self.wiimote.memory.write(0xa20008, [0x01])
-        self._com._send(RPT_SPKR_MUTE, OFF)
-        time.sleep(0.05)
-        num_samples = 20
-        # samples = [0, 30, 60, 90, 120, 90, 60, 30, 0, 255-30, 255-60, 255-90, 255-120, 255-90, 255-60, 255-30, 0, 0, 0, 0]
-        # samples = [0, 120, 240, 0, 120, 240, 0, 120, 240, 0, 120, 240, 0, 120, 240, 0, 120, 240, 0, 0]
-        # samples = [128,167,202,231,249,255,249,231,202,167,128,88,53,24,6,0,6,24,53,88,]
-        # samples = [0, 30, 60, 90, 120, 150, 180, 210, 240, 210, 180, 150, 120, 90, 60, 30, 0, 0, 0, 0]
-        samples = [255-128, 255-167, 255-202, 255-231, 255-249, 255-255, 255-249, 255-231, 255-202, 255-167, 255-128, 88, 53, 24, 6, 0, 6, 24, 53, 88, ]
-        for _ in range(20):
-            self._com._send(RPT_SPKR_PLAY, num_samples << 3, samples)
-            time.sleep(0.01)
-            # currently, timing does not seem to be the reason why  audio sounds awful - stay with time.sleep()
-            # nsleep(9000)
-        self._com._send(RPT_SPKR_ON, OFF)
-        self._playing = False
+        with self._send_lock:
+            self.wiimote._com.set_rumble(self._motor)
 
 
-class IRCam(object):
+class YamahaADPCMEncoder(object):
     """
-    Represents the infrared camera of the Wiimote.
+    Encoder for the 4-bit Yamaha ADPCM format understood by the Wiimote's speaker
+    (same algorithm as ffmpeg's adpcm_yamaha). Keeps its state between blocks,
+    so a stream can be encoded block by block.
     """
 
-    MODE_BASIC = 1
-    MODE_EXTENDED = 3
-    MODE_FULL = 5
+    INDEX_SCALE = [230, 230, 230, 230, 307, 409, 512, 614] * 2
+    DIFF_LOOKUP = [1, 3, 5, 7, 9, 11, 13, 15, -1, -3, -5, -7, -9, -11, -13, -15]
 
-    # adapted from WiiBrew list, higher index means higher sensitivity
-    SENSITIVITY_BLOCKS = [
-        ([0x02, 0x00, 0x00, 0x71, 0x01, 0x00, 0x64, 0x00, 0xfe], [0xfd, 0x05]),  # Wii Level 1
-        ([0x02, 0x00, 0x00, 0x71, 0x01, 0x00, 0x96, 0x00, 0xb4], [0xb3, 0x04]),  # Wii Level 2
-        ([0x02, 0x00, 0x00, 0x71, 0x01, 0x00, 0xaa, 0x00, 0x64], [0x63, 0x03]),  # Wii Level 3
-        ([0x02, 0x00, 0x00, 0x71, 0x01, 0x00, 0xc8, 0x00, 0x36], [0x35, 0x03]),  # Wii Level 4
-        ([0x07, 0x00, 0x00, 0x71, 0x01, 0x00, 0x72, 0x00, 0x20], [0x1f, 0x03]),  # Wii Level 5
-        ([0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0xff, 0x00, 0x0c], [0x00, 0x00]),  # Max Sensitivity
-    ]
+    def __init__(self):
+        self.predictor = 0
+        self.step = 127
+        self._leftover = None  # first sample of an incomplete byte
 
-    SUPPORTED_REPORTS = [0x33, 0x36, 0x37, 0x3e, 0x3f]
+    def _nibble(self, sample):
+        delta = sample - self.predictor
+        nibble = min(7, abs(delta) * 4 // self.step) + (8 if delta < 0 else 0)
+        self.predictor += int(self.step * self.DIFF_LOOKUP[nibble] / 8)
+        self.predictor = max(-32768, min(32767, self.predictor))
+        self.step = max(127, min(24576, (self.step * self.INDEX_SCALE[nibble]) >> 8))
+        return nibble
 
-    def __init__(self, wiimote):
-        self.wiimote = wiimote
-        self._com = wiimote._com
-        self._state = []
-        self._callbacks = []
-        self._mode = self.MODE_EXTENDED
-        self._sensitivity = 3
-        self.set_mode_sensitivity(self._mode, self._sensitivity)
+    def encode(self, samples):
+        """
+        Encodes signed 16-bit samples into bytes holding two samples each
+        (first sample in the high nibble).
+        """
+        out = bytearray()
+        for sample in samples:
+            nibble = self._nibble(int(sample))
+            if self._leftover is None:
+                self._leftover = nibble
+            else:
+                out.append((self._leftover << 4) + nibble)
+                self._leftover = None
+        return bytes(out)
 
-    def __len__(self):
-        return len(self._state)
+    def flush(self):
+        """
+        Returns the last sample of an odd-length stream as a byte (padded
+        with a zero nibble), or an empty bytes object.
+        """
+        if self._leftover is None:
+            return b''
+        out = bytes((self._leftover << 4,))
+        self._leftover = None
+        return out
 
-    def __repr__(self):
-        return repr(self._state)
 
-    def __getitem__(self, slot):
-        if 0 <= slot < len(self._state):
-            return self._state[slot]
-        else:
-            raise IndexError("list index out of range")
+def _encode_pcm8(samples):
+    """
+    Converts signed 16-bit samples into signed 8-bit PCM bytes.
+    """
+    if np is not None:
+        return (np.asarray(samples, dtype=np.int16) >> 8).astype(np.int8).tobytes()
+    return bytes((int(sample) >> 8) & 0xff for sample in samples)
 
-    def set_mode_sensitivity(self, mode, sensitivity):
-        """
+
+class SpeakerStream(threading.Thread):
+    """
+    Plays audio on the Wiimote's speaker from a dedicated thread.
+    Audio is taken from `source` as blocks of signed 16-bit samples, encoded
+    block by block, and sent as speaker reports of 20 bytes each. Reports are
+    paced against absolute deadlines, so that sleep inaccuracies do not add up.
+    `source` may be a single buffer (list, array, bytes-like object), an
+    iterable (e.g. a generator) yielding such buffers, or None, in which case
+    blocks have to be passed to `write()`.
+    Whenever no data is available at a deadline or the stream falls behind
+    by more than one report, `underruns` is increased.
+    """
+
+    BYTES_PER_REPORT = 20
+
+    def __init__(self, speaker, source, fmt, sample_rate, volume):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self._speaker = speaker
+        self._com = speaker._com
+        self.format = fmt
+        self.sample_rate = sample_rate
+        self.volume = volume
+        samples_per_byte = 1 if fmt == Speaker.FORMAT_PCM8 else 2
+        self.period = self.BYTES_PER_REPORT * samples_per_byte / sample_rate
+        self.underruns = 0
+        self.reports_sent = 0
+        self.running = False
+        if source is None:
+            self._blocks = None
+            self._queue = collections.deque()
+        elif hasattr(source, '__len__'):
+            self._blocks = iter([source])
+        else:
+            self._blocks = iter(source)
+        if fmt == Speaker.FORMAT_PCM8:
+            self._encoder = None
+            self._encode = _encode_pcm8
+        else:
+            self._encoder = YamahaADPCMEncoder()
+            self._encode = self._encoder.encode
+
+    def write(self, samples):
+        """
+        Queue a block of samples for playback (only if created without source).
+        """
+        if self._blocks is not None:
+            raise RuntimeError("Stream plays from a source, write() not supported")
+        self._queue.append(samples)
+
+    def stop(self):
+        self.running = False
+
+    def _next_block(self):
+        """
+        Returns the next block of samples, None if none is available right now,
+        or raises StopIteration at the end of the source.
+        """
+        if self._blocks is not None:
+            return next(self._blocks)
+        if not self.running:
+            raise StopIteration
+        return self._queue.popleft() if self._queue else None
+
+    def run(self):
+        self.running = True
+        self._speaker._configure(self.format, self.sample_rate, self.volume)
+        pending = bytearray()
+        exhausted = False
+        deadline = time.monotonic()
+        while self.running:
+            while len(pending) < self.BYTES_PER_REPORT and not exhausted:
+                try:
+                    block = self._next_block()
+                except StopIteration:
+                    exhausted = True
+                    if self._encoder is not None:
+                        pending += self._encoder.flush()
+                    break
+                if block is None:
+                    break
+                pending += self._encode(block)
+            if pending:
+                chunk = pending[:self.BYTES_PER_REPORT]
+                del pending[:self.BYTES_PER_REPORT]
+                self._com.send_speaker_data(chunk)
+                self.reports_sent += 1
+            elif exhausted:
+                break
+            else:
+                self.underruns += 1
+            deadline += self.period
+            delay = deadline - time.monotonic()
+            if delay > 0:
+                nsleep(delay * 1000000)
+            elif delay < -self.period:  # more than one report late
+                self.underruns += 1
+                deadline = time.monotonic()
+        self.running = False
+        self._speaker._shutdown()
+
+
+class Speaker(object):
+    """
+    Represents the speaker of the Wiimote.
+    """
+
+    RPT_SPKR_ON = 0x14
+    RPT_SPKR_PLAY = 0x18
+    RPT_SPKR_MUTE = 0x19
+
+    FORMAT_ADPCM = 0x00  # 4-bit Yamaha ADPCM
+    FORMAT_PCM8 = 0x40  # 8-bit signed PCM
+
+    def __init__(self, wiimote):
+        self.wiimote = wiimote
+        self._com = wiimote._com
+        self._stream = None
+
+    def play(self, source=None, fmt=FORMAT_PCM8, sample_rate=2000, volume=0x40):
+        """
+        Starts playing signed 16-bit samples from `source` in the background
+        and returns the `SpeakerStream`. See `SpeakerStream` for valid sources.
+        Any sound that is still playing is stopped.
+        fmt: `Speaker.FORMAT_PCM8` or `Speaker.FORMAT_ADPCM`
+        """
+        self.stop()
+        self._stream = SpeakerStream(self, source, fmt, sample_rate, volume)
+        self._stream.start()
+        return self._stream
+
+    def stop(self):
+        """
+        Stops playback and waits until the speaker has been switched off.
+        """
+        stream = self._stream
+        if stream is not None and stream.is_alive():
+            stream.stop()
+            if stream is not threading.current_thread():
+                stream.join()
+
+    def playing(self):
+        return self._stream is not None and self._stream.is_alive()
+
+    def beep(self, frequency=500, duration=0.2):
+        """
+        Play a short beep through the speaker. Does not block.
+        """
+        if self.playing():
+            return
+        sample_rate = 2000
+        samples = [int(16000 * math.sin(2 * math.pi * frequency * i / sample_rate))
+                   for i in range(int(sample_rate * duration))]
+        self.play(samples, self.FORMAT_PCM8, sample_rate)
+
+    def _configure(self, fmt, sample_rate, volume):
+        """
+        Switches on the speaker and sets format, sample rate and volume.
+        See http://wiibrew.org/wiki/Wiimote#Speaker
+        """
+        ON = 0x04
+        OFF = 0x00
+        base = 12000000 if fmt == self.FORMAT_PCM8 else 6000000
+        rate = _val_to_byte_list(base // sample_rate, 2, big_endian=False)
+        self._com._send(self.RPT_SPKR_ON, ON)
+        self._com._send(self.RPT_SPKR_MUTE, ON)
+        self.wiimote.memory.write(0xa20009, [0x01])
+        self.wiimote.memory.write(0xa20001, [0x08])
+        self.wiimote.memory.write(0xa20001, [0x00, fmt, rate, volume, 0x00, 0x00])
+        self.wiimote.memory.write(0xa20008, [0x01])
+        self._com._send(self.RPT_SPKR_MUTE, OFF)
+
+    def _shutdown(self):
+        self._com._send(self.RPT_SPKR_ON, 0x00)
+
+
+class IRPoint(collections.namedtuple('IRPoint', 'id x y size xmin ymin xmax ymax intensity',
+                                      defaults=(None,) * 6)):
+    """
+    An object seen by the IR camera in slot `id` (0-3) at `x` (0-1023) and
+    `y` (0-767). `size` (0-15) is None in basic mode. Bounding box
+    (`xmin`, `ymin`, `xmax`, `ymax`, 0-127) and `intensity` (0-255) are only
+    sent in full mode.
+    Fields can also be read by name like a dictionary, e.g. `point['x']`.
+    """
+
+    __slots__ = ()
+
+    def __getitem__(self, key):
+        if type(key) is str:
+            try:
+                return getattr(self, key)
+            except AttributeError:
+                raise KeyError(key)
+        return tuple.__getitem__(self, key)
+
+
+_new_point = tuple.__new__  # skips argument parsing of IRPoint()
+_NO_BOX = (None,) * 5
+_NO_FULL_DATA = (None,) * 6
+
+
+class IRCam(object):
+    """
+    Represents the infrared camera of the Wiimote.
+    Visible objects are provided as a list of `IRPoint`.
+    """
+
+    MODE_BASIC = 1
+    MODE_EXTENDED = 3
+    MODE_FULL = 5
+
+    # adapted from WiiBrew list, higher index means higher sensitivity
+    SENSITIVITY_BLOCKS = [
+        ([0x02, 0x00, 0x00, 0x71, 0x01, 0x00, 0x64, 0x00, 0xfe], [0xfd, 0x05]),  # Wii Level 1
+        ([0x02, 0x00, 0x00, 0x71, 0x01, 0x00, 0x96, 0x00, 0xb4], [0xb3, 0x04]),  # Wii Level 2
+        ([0x02, 0x00, 0x00, 0x71, 0x01, 0x00, 0xaa, 0x00, 0x64], [0x63, 0x03]),  # Wii Level 3
+        ([0x02, 0x00, 0x00, 0x71, 0x01, 0x00, 0xc8, 0x00, 0x36], [0x35, 0x03]),  # Wii Level 4
+        ([0x07, 0x00, 0x00, 0x71, 0x01, 0x00, 0x72, 0x00, 0x20], [0x1f, 0x03]),  # Wii Level 5
+        ([0x00, 0x00, 0x00, 0x00, 0x00, 0x00, 0xff, 0x00, 0x0c], [0x00, 0x00]),  # Max Sensitivity
+    ]
+
+    def __init__(self, wiimote):
+        self.wiimote = wiimote
+        self._com = wiimote._com
+        self._state = []
+        self._callbacks = []
+        self._enabled = False
+        self._raw = None  # (parser, data) stored by _store_*() in lazy decoding mode
+        self._decoded = None
+        self._partial = None  # objects 0 and 1 from report 0x3e
+        self.history = None
+        self._mode = self.MODE_EXTENDED
+        self._sensitivity = 3
+        self._configured = None  # (data format, sensitivity) while the camera is on
+
+    def __len__(self):
+        return len(self._load())
+
+    def __repr__(self):
+        return repr(self._load())
+
+    def __getitem__(self, slot):
+        if not self._enabled:
+            _auto_enable(self)
+        state = self._load()
+        if 0 <= slot < len(state):
+            return state[slot]
+        else:
+            raise IndexError("list index out of range")
+
+    def set_mode_sensitivity(self, mode, sensitivity):
+        """
         Sets sensitivity and verbosity of IR camera.
         Valid values for mode: `IRCam.MODE_BASIC`, `IRCam.MODE_EXTENDED`, `IRCam.MODE_FULL`.
-        Valid values for sensitivity: 0 (lowest) to 6 (highest).
+        Valid values for sensitivity: 0 (lowest) to 5 (highest).
         Default mode: MODE_EXTENDED
         Default sensitivity: 3
+        Extended data is sent as basic data while extension data is needed, too.
+        The camera is only switched on while IR data is in use (see `enable()`).
         See WiiBrew documentation.
         """
-        if sensitivity > len(self.SENSITIVITY_BLOCKS) - 1 or \
-           (mode not in [self.MODE_BASIC, self.MODE_EXTENDED, self.MODE_FULL]):
-            raise TypeError("wrong mode or sensitivity level given")
-        self._mode = mode
-        self._sensitivity = sensitivity
-        self._com.set_report_mode(0x33)  # todo: adjust for other modes!!
-        self._com._send(0x13, 0x04)
-        self._com._send(0x1a, 0x04)
-        self.wiimote.memory.write(0xb00030, 0x08, eeprom=False)
-        self.wiimote.memory.write(0xb00000, self.SENSITIVITY_BLOCKS[mode][0], eeprom=False)
-        self.wiimote.memory.write(0xb0001a, self.SENSITIVITY_BLOCKS[mode][1], eeprom=False)
-        self.wiimote.memory.write(0xb00033, mode, eeprom=False)
-        self.wiimote.memory.write(0xb00030, 0x08, eeprom=False)
+        if not 0 <= sensitivity < len(self.SENSITIVITY_BLOCKS) or \
+           (mode not in [self.MODE_BASIC, self.MODE_EXTENDED, self.MODE_FULL]):
+            raise TypeError("wrong mode or sensitivity level given")
+        self._mode = mode
+        self._sensitivity = sensitivity
+        self.wiimote._update_report_mode()
+
+    def enable(self):
+        """
+        Switch on the IR camera and request IR data from the Wiimote.
+        Happens automatically when values are read, when registering a
+        callback, or when enabling the history.
+        """
+        self._enabled = True
+        _update_or_undo(self.wiimote, self._undo_enable)
+
+    def _undo_enable(self):
+        self._enabled = False
+
+    def disable(self):
+        """
+        Switch off the IR camera unless callbacks or a history need it.
+        """
+        self._enabled = False
+        self.wiimote._update_report_mode()
+
+    def in_use(self):
+        return self._enabled or bool(self._callbacks) or self.history is not None
+
+    def _needs_decoding(self):
+        return bool(self._callbacks) or self.history is not None
+
+    def _configure(self, data_format):
+        """
+        Switches the camera on (if necessary) and sets data format and sensitivity.
+        """
+        memory = self.wiimote.memory
+        if self._configured is None:
+            self._com._send(0x13, 0x04)
+            self._com._send(0x1a, 0x04)
+        blocks = self.SENSITIVITY_BLOCKS[self._sensitivity]
+        memory.write(0xb00030, 0x08, eeprom=False)
+        memory.write(0xb00000, blocks[0], eeprom=False)
+        memory.write(0xb0001a, blocks[1], eeprom=False)
+        memory.write(0xb00033, data_format, eeprom=False)
+        memory.write(0xb00030, 0x08, eeprom=False)
+        self._configured = (data_format, self._sensitivity)
+
+    def _power_off(self):
+        self._com._send(0x13, 0x00)
+        self._com._send(0x1a, 0x00)
+        self._configured = None
+        self._raw = self._decoded = None
+        self._state = []
+
+    def get_state(self):
+        if not self._enabled:
+            _auto_enable(self)
+        return self._load()
+
+    def set_sensitivity(self, sensitivity):
+        self.set_mode_sensitivity(self._mode, sensitivity)
+
+    def set_mode(self, mode):
+        self.set_mode_sensitivity(mode, self._sensitivity)
+
+    def enable_history(self, capacity=1024):
+        """
+        Keep the last `capacity` IR samples with timestamps in `self.history`
+        (see `SampleHistory`). Each sample holds x, y, and size of all four
+        IR slots; empty slots are stored as (1023, 1023, 0).
+        """
+        self.history = SampleHistory(12, capacity)
+        _update_or_undo(self.wiimote, self._undo_history)
+
+    def disable_history(self):
+        self.history = None
+        self.wiimote._update_report_mode()
+
+    def _undo_history(self):
+        self.history = None
+
+    def _store_history(self):
+        values = [0x3ff, 0x3ff, 0] * 4
+        for ir_obj in self._state:
+            slot = ir_obj.id * 3
+            values[slot:slot + 3] = ir_obj.x, ir_obj.y, ir_obj.size or 0
+        self.history.append(self._com.report_time, values)
+
+    def register_callback(self, func, policy=None, maxsize=64):
+        """
+        Register a callback function `func` that gets called every time
+        when new IR data is transmitted from the Wiimote.
+        A list of all visible IR objects (`IRPoint`) is passed to the callback function.
+        If `policy` is given (see `Subscription`), `func` is called from a
+        worker thread of the Wiimote's `CallbackDispatcher` with up to
+        `maxsize` events queued.
+        """
+        _add_callback(self._callbacks, self.wiimote, func, policy, maxsize)
+        _update_or_undo(self.wiimote, lambda: _remove_callback(self._callbacks, func))
+
+    def unregister_callback(self, func):
+        _remove_callback(self._callbacks, func)
+        self.wiimote._update_report_mode()
+
+    def _notify_callbacks(self):
+        stats = self._com.stats
+        if stats is not None:
+            stats._call(self._callbacks, self._state)
+            return
+        for callback in self._callbacks:
+            callback(self._state)
+
+    def handle_report(self, report):
+        """
+        Extract IR data from a Wiimote report.
+        """
+        _decode_report(self, 'ir', report)
+
+    @staticmethod
+    def _parse_basic(report, offset):
+        """
+        Returns the IR objects in basic format (10 bytes, no size information).
+        """
+        state = []
+        for pair in range(2):
+            o = offset + pair * 5
+            hi = report[o + 2]
+            y = report[o + 1] + ((hi & 0b11000000) << 2)
+            if y != 0x3ff:  # all bits set: no object
+                x = report[o] + ((hi & 0b00110000) << 4)
+                state.append(_new_point(IRPoint, (pair * 2, x, y) + _NO_FULL_DATA))
+            y = report[o + 4] + ((hi & 0b00001100) << 6)
+            if y != 0x3ff:
+                x = report[o + 3] + ((hi & 0b00000011) << 8)
+                state.append(_new_point(IRPoint, (pair * 2 + 1, x, y) + _NO_FULL_DATA))
+        return state
+
+    @staticmethod
+    def _parse_extended(report, offset):
+        """
+        Returns the IR objects in extended format (12 bytes).
+        """
+        state = []
+        for ir_obj in range(4):
+            o = offset + ir_obj * 3
+            y = report[o + 1] + ((report[o + 2] & 0b11000000) << 2)
+            if y != 0x3ff:  # all bits set: no object
+                x = report[o] + ((report[o + 2] & 0b00110000) << 4)
+                size = report[o + 2] & 0b00001111
+                state.append(_new_point(IRPoint, (ir_obj, x, y, size) + _NO_BOX))
+        return state
+
+    @staticmethod
+    def _parse_full(report, offset, first_id):
+        """
+        Returns the two IR objects in full format (9 bytes each) of one
+        half of an interleaved report pair.
+        """
+        state = []
+        for ir_obj in range(2):
+            o = offset + ir_obj * 9
+            y = report[o + 1] + ((report[o + 2] & 0b11000000) << 2)
+            if y != 0x3ff:  # all bits set: no object
+                x = report[o] + ((report[o + 2] & 0b00110000) << 4)
+                state.append(_new_point(IRPoint, (
+                    first_id + ir_obj, x, y, report[o + 2] & 0b00001111,
+                    report[o + 3] & 0x7f, report[o + 4] & 0x7f,
+                    report[o + 5] & 0x7f, report[o + 6] & 0x7f, report[o + 8])))
+        return state
+
+    def _store_basic(self, report, offset, length):
+        """
+        Keeps a copy of the raw data for decoding on access (lazy decoding mode).
+        """
+        self._raw = (self._parse_basic, bytes(report[offset:offset + length]))
+
+    def _store_extended(self, report, offset, length):
+        self._raw = (self._parse_extended, bytes(report[offset:offset + length]))
+
+    def _load(self):
+        """
+        Returns the current state, decoding the latest raw data first if necessary.
+        """
+        raw = self._raw
+        if raw is not self._decoded:
+            self._state = raw[0](raw[1], 0)
+            self._decoded = raw
+        return self._state
+
+    def _decode_basic(self, report, offset, length):
+        """
+        Decode four IR objects in basic format (10 bytes, no size information).
+        Usually gets called by the Wiimote CommunicationHandler object.
+        """
+        self._state = self._parse_basic(report, offset)
+        self._raw = self._decoded = None
+        if self.history is not None:
+            self._store_history()
+        self._notify_callbacks()
+
+    def _decode_extended(self, report, offset, length):
+        """
+        Decode four IR objects in extended format (12 bytes).
+        Usually gets called by the Wiimote CommunicationHandler object.
+        """
+        self._state = self._parse_extended(report, offset)
+        self._raw = self._decoded = None
+        if self.history is not None:
+            self._store_history()
+        self._notify_callbacks()
+
+    def _decode_full_a(self, report, offset, length):
+        """
+        Keep IR objects 0 and 1 (full format) from report 0x3e until report 0x3f follows.
+        """
+        self._partial = self._parse_full(report, offset, 0)
+
+    def _decode_full_b(self, report, offset, length):
+        """
+        Decode IR objects 2 and 3 (full format) from report 0x3f and
+        publish all four objects.
+        """
+        partial, self._partial = self._partial, None
+        if partial is None:  # first half got lost
+            return
+        self._state = partial + self._parse_full(report, offset, 2)
+        self._raw = self._decoded = None
+        if self.history is not None:
+            self._store_history()
+        self._notify_callbacks()
+
+
+class Homography(object):
+    """
+    Projective mapping from IR camera coordinates to screen coordinates,
+    given as a 3x3 matrix (list of rows).
+    Use `from_points()` to calibrate it from four camera points, e.g. the
+    IR pen held at the four corners of the screen.
+    """
+
+    def __init__(self, matrix):
+        self.matrix = [list(map(float, row)) for row in matrix]
+
+    def __repr__(self):
+        return "<Homography %r>" % (self.matrix,)
+
+    @classmethod
+    def from_points(cls, camera_points, screen_points):
+        """
+        Computes the homography that maps the four (x, y) `camera_points`
+        onto the corresponding four `screen_points`.
+        """
+        if len(camera_points) != 4 or len(screen_points) != 4:
+            raise ValueError("exactly four point pairs are needed")
+        # h0..h7 with h8 = 1: two linear equations per point pair
+        rows = []
+        for (x, y), (u, v) in zip(camera_points, screen_points):
+            rows.append([x, y, 1.0, 0.0, 0.0, 0.0, -u * x, -u * y, u])
+            rows.append([0.0, 0.0, 0.0, x, y, 1.0, -v * x, -v * y, v])
+        h = _solve(rows)
+        return cls([h[0:3], h[3:6], [h[6], h[7], 1.0]])
+
+    def map(self, x, y):
+        """
+        Returns the screen coordinates (x, y) of camera point (`x`, `y`).
+        """
+        m = self.matrix
+        w = m[2][0] * x + m[2][1] * y + m[2][2]
+        return ((m[0][0] * x + m[0][1] * y + m[0][2]) / w,
+                (m[1][0] * x + m[1][1] * y + m[1][2]) / w)
+
+    def map_array(self, points):
+        """
+        Maps an array of camera points with shape (..., 2) to screen
+        coordinates in one vectorized operation (requires NumPy), e.g. the
+        x/y values of `SampleHistory` or `decode_batch()` results.
+        Empty IR slots (1023, 1023) need to be masked out by the caller.
+        """
+        if np is None:
+            raise RuntimeError("NumPy is required for batch processing")
+        points = np.asarray(points, dtype=np.float64)
+        m = np.array(self.matrix)
+        x, y = points[..., 0], points[..., 1]
+        w = m[2, 0] * x + m[2, 1] * y + m[2, 2]
+        return np.stack(((m[0, 0] * x + m[0, 1] * y + m[0, 2]) / w,
+                         (m[1, 0] * x + m[1, 1] * y + m[1, 2]) / w), axis=-1)
+
+
+def _solve(rows):
+    """
+    Solves a linear system given as rows of an augmented matrix
+    (Gaussian elimination with partial pivoting).
+    """
+    n = len(rows)
+    for col in range(n):
+        pivot = max(range(col, n), key=lambda r: abs(rows[r][col]))
+        if abs(rows[pivot][col]) < 1e-12:
+            raise ValueError("points are degenerate (three of them on a line?)")
+        rows[col], rows[pivot] = rows[pivot], rows[col]
+        for r in range(col + 1, n):
+            factor = rows[r][col] / rows[col][col]
+            for c in range(col, n + 1):
+                rows[r][c] -= factor * rows[col][c]
+    result = [0.0] * n
+    for r in range(n - 1, -1, -1):
+        result[r] = (rows[r][n] - sum(rows[r][c] * result[c] for c in range(r + 1, n))) / rows[r][r]
+    return result
+
+
+class IRTrack(collections.namedtuple('IRTrack', 'id x y size slot age screen_x screen_y')):
+    """
+    A tracked IR object. `id` stays the same for as long as the object is
+    visible, even if the camera reports it in a different `slot`.
+    `x`/`y` are (smoothed) camera coordinates, `age` counts the reports the
+    track has been seen in. `screen_x`/`screen_y` are None without homography.
+    """
+
+    __slots__ = ()
+
+
+class IRTracker(object):
+    """
+    Follows the objects seen by an `IRCam` from report to report.
+    Every object is matched to the nearest track of the previous report
+    (at most `max_distance` camera pixels away), so track IDs stay stable
+    when objects change slots. A track that is not seen is kept for up to
+    `max_missing` reports before its ID is retired.
+    With `smoothing` between 0 and 1, positions are averaged exponentially
+    (higher values: smoother, but more lag).
+    If a `Homography` is set, tracks also carry screen coordinates.
+    """
+
+    def __init__(self, ir, max_distance=100, max_missing=2, smoothing=0.0, homography=None):
+        if not 0.0 <= smoothing < 1.0:
+            raise ValueError("smoothing needs to be between 0 and 1")
+        self.ir = ir
+        self.max_distance = max_distance
+        self.max_missing = max_missing
+        self.smoothing = smoothing
+        self.homography = homography
+        self.tracks = []  # visible tracks after the latest report
+        self._callbacks = []
+        self._active = {}  # id -> [raw x, raw y, x, y, age, missed]
+        self._next_id = 0
+        ir.register_callback(self._update)
+
+    def close(self):
+        self.ir.unregister_callback(self._update)
+
+    def register_callback(self, func):
+        """
+        Register a callback function `func` that gets called with the list
+        of visible `IRTrack`s after every IR report.
+        """
+        self._callbacks.append(func)
+
+    def unregister_callback(self, func):
+        if func in self._callbacks:
+            self._callbacks.remove(func)
+
+    def _match(self, points):
+        """
+        Returns (track ID, point) pairs, closest pairs first.
+        """
+        max_dist = self.max_distance ** 2
+        pairs = []
+        for track_id, track in self._active.items():
+            for point in points:
+                dist = (point.x - track[0]) ** 2 + (point.y - track[1]) ** 2
+                if dist <= max_dist:
+                    pairs.append((dist, track_id, point))
+        pairs.sort(key=lambda pair: pair[0])
+        matched = []
+        used_tracks = set()
+        used_points = set()
+        for _, track_id, point in pairs:
+            if track_id not in used_tracks and point.id not in used_points:
+                used_tracks.add(track_id)
+                used_points.add(point.id)
+                matched.append((track_id, point))
+        return matched
+
+    def _update(self, points):
+        matched = self._match(points)
+        seen = {point.id for _, point in matched}
+        for point in points:
+            if point.id not in seen:
+                self._active[self._next_id] = [point.x, point.y, point.x, point.y, 0, 0]
+                matched.append((self._next_id, point))
+                self._next_id += 1
+        alpha = self.smoothing
+        homography = self.homography
+        tracks = []
+        for track_id, point in matched:
+            track = self._active[track_id]
+            track[0], track[1] = point.x, point.y
+            if track[4] and alpha:
+                track[2] += (1.0 - alpha) * (point.x - track[2])
+                track[3] += (1.0 - alpha) * (point.y - track[3])
+            else:
+                track[2], track[3] = point.x, point.y
+            track[4] += 1
+            track[5] = 0
+            screen_x = screen_y = None
+            if homography is not None:
+                screen_x, screen_y = homography.map(track[2], track[3])
+            tracks.append(IRTrack(track_id, track[2], track[3], point.size, point.id,
+                                  track[4], screen_x, screen_y))
+        matched_ids = {track_id for track_id, _ in matched}
+        for track_id in list(self._active):
+            if track_id not in matched_ids:
+                self._active[track_id][5] += 1
+                if self._active[track_id][5] > self.max_missing:
+                    del self._active[track_id]
+        tracks.sort(key=lambda track: track.id)
+        self.tracks = tracks
+        for callback in self._callbacks:
+            callback(tracks)
+
+
+class MemoryRequest(object):
+    """
+    A memory read that has been sent to the Wiimote.
+    Gets completed by the CommunicationHandler thread once all requested bytes
+    have been received or the Wiimote replied with an error.
+    """
+
+    def __init__(self, address, amount, eeprom):
+        self.address = address
+        self.amount = amount
+        self.eeprom = eeprom
+        self.data = []
+        self.error = None
+        self._done = threading.Event()
+        self._lock = threading.Lock()
+        self._callbacks = []
+
+    def done(self):
+        return self._done.is_set()
+
+    def add_done_callback(self, func):
+        """
+        Register a callback function `func` that gets called with this request
+        as parameter once it is completed. If the request has already been
+        completed, `func` is called immediately.
+        """
+        with self._lock:
+            if not self._done.is_set():
+                self._callbacks.append(func)
+                return
+        func(self)
+
+    def result(self, timeout=None):
+        """
+        Waits up to `timeout` seconds (forever if None) for the request to
+        complete and returns the data read as a list of integers.
+        Raises TimeoutError if no reply arrived in time and RuntimeError if
+        the Wiimote reported an error.
+        """
+        if not self._done.wait(timeout):
+            raise TimeoutError("Memory read at 0x%06x timed out" % self.address)
+        if self.error is not None:
+            raise RuntimeError("Error condition %x received during memory read!" % self.error)
+        return self.data
+
+    def _complete(self, error=None):
+        self.error = error
+        with self._lock:
+            self._done.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for callback in callbacks:
+            callback(self)
+
+
+class Memory(object):
+
+    RPT_READ = 0x17
+    RPT_WRITE = 0x16
+
+    MAX_ADDRESS = 0x16FF
+
+    DEFAULT_TIMEOUT = 1.0  # seconds
+    WRITE_WINDOW = 4  # max. number of write requests waiting for an acknowledgement
+
+    def __init__(self, wiimote):
+        self.wiimote = wiimote
+        self._com = wiimote._com
+        # read requests are answered one after another, the first one
+        # in this queue is the one currently being served by the Wiimote
+        self._pending = collections.deque()
+        self._lock = threading.Lock()
+        # keeps the write requests of concurrent write() calls in order
+        self._write_lock = threading.Lock()
+        # write requests from the receive thread, sent by the thread holding _write_lock
+        self._deferred = collections.deque()
+        self._ack_condition = threading.Condition()
+        self._writes_outstanding = 0
+        self._write_error = None
+
+    def write(self, address, data, eeprom=False, timeout=DEFAULT_TIMEOUT):
+        """
+        Writes `data` (an integer or a list of integers) starting at `address`.
+        Data is split into 16-byte write requests. Up to `WRITE_WINDOW` of them
+        are sent before waiting for the Wiimote to acknowledge them.
+        Blocks until all requests have been acknowledged, raises TimeoutError if
+        an acknowledgement does not arrive within `timeout` seconds and
+        RuntimeError if the Wiimote reported an error.
+        When called from the CommunicationHandler thread (i.e., from a callback),
+        acknowledgements can not be received, so all requests are sent without
+        waiting. If another thread is writing at that time, the requests are
+        handed over to it and sent after its own requests, so they are
+        already queued but not necessarily sent when write() returns.
+        """
+        bytes_to_send = _flatten(data)
+        amount = len(bytes_to_send)
+        if eeprom and address + amount > Memory.MAX_ADDRESS:
+            raise ValueError("EEPROM address needs to be between 0x0000 and 0x16FF")
+        if address < 0 or address + amount - 1 > 0xffffff:
+            raise ValueError("Memory address needs to be between 0x000000 and 0xFFFFFF")
+        chunks = [(address + start, bytes_to_send[start:start + 16], eeprom)
+                  for start in range(0, amount, 16)]
+        if self._com.in_receive_thread():
+            # never wait for _write_lock here: its holder may be waiting for
+            # acknowledgements that only this thread can deliver
+            self._deferred.extend(chunks)
+            self._send_deferred()
+            return
+        try:
+            with self._write_lock:
+                self._write_error = None
+                for chunk in chunks:
+                    self._wait_for_acks(Memory.WRITE_WINDOW - 1, timeout)
+                    self._send_chunk(chunk)
+                while self._deferred:
+                    self._wait_for_acks(Memory.WRITE_WINDOW - 1, timeout)
+                    self._send_chunk(self._deferred.popleft())
+                self._wait_for_acks(0, timeout)
+                if self._write_error is not None:
+                    raise RuntimeError("Error condition %x received during memory write!" %
+                                       self._write_error)
+        finally:
+            # requests deferred after the loop above
+            self._send_deferred()
+
+    def _send_deferred(self):
+        """
+        Sends write requests deferred by the receive thread without waiting
+        for acknowledgements, unless another thread holds _write_lock.
+        Whoever holds the lock checks again after releasing it, so no request
+        is left behind.
+        """
+        while self._deferred and self._write_lock.acquire(blocking=False):
+            try:
+                while self._deferred:
+                    self._send_chunk(self._deferred.popleft())
+            finally:
+                self._write_lock.release()
+
+    def _send_chunk(self, chunk):
+        with self._ack_condition:
+            self._writes_outstanding += 1
+        self._send_write(*chunk)
+
+    def _wait_for_acks(self, max_outstanding, timeout):
+        with self._ack_condition:
+            if not self._ack_condition.wait_for(
+                    lambda: self._writes_outstanding <= max_outstanding, timeout):
+                self._writes_outstanding = 0  # give up on lost acknowledgements
+                raise TimeoutError("Memory write was not acknowledged in time")
+
+    def _send_write(self, address, chunk, eeprom):
+        self._com.send_write_request(address, chunk, eeprom)
+
+    def read(self, address, amount, eeprom=False, timeout=DEFAULT_TIMEOUT):
+        """
+        Reads `amount` bytes starting at `address` and returns them as a list
+        of integers. Blocks until the data has been received or `timeout`
+        seconds have passed (TimeoutError).
+        Concurrent reads are queued and served in order.
+        Cannot be called from callbacks, as the data arrives in the receive
+        thread. Use `request_read()` there.
+        """
+        if self._com.in_receive_thread():
+            raise RuntimeError("Memory.read() would block the receive thread, use request_read()")
+        request = self.request_read(address, amount, eeprom)
+        try:
+            return request.result(timeout)
+        except TimeoutError:
+            self._cancel(request)
+            raise
+
+    def request_read(self, address, amount, eeprom=False):
+        """
+        Non-blocking variant of `read()`. Returns a `MemoryRequest` that gets
+        completed once the Wiimote has sent all requested data.
+        """
+        if eeprom and address + amount > Memory.MAX_ADDRESS:
+            raise ValueError("EEPROM address needs to be between 0x0000 and 0x16FF")
+        if not 0 <= address <= 0xffffff:
+            raise ValueError("Memory address needs to be between 0x000000 and 0xFFFFFF")
+        if not 0 < amount <= 0xffff:
+            raise ValueError("Read size needs to be between 1 and 0xFFFF bytes")
+        request = MemoryRequest(address, amount, eeprom)
+        with self._lock:
+            self._pending.append(request)
+            if len(self._pending) == 1:
+                self._send_read(request)
+        return request
+
+    def _send_read(self, request):
+        self._com.send_read_request(request.address, request.amount, request.eeprom)
+
+    def _cancel(self, request):
+        """
+        Removes a request that timed out from the queue and moves on to the next one.
+        """
+        with self._lock:
+            if request not in self._pending:
+                return
+            was_active = self._pending[0] is request
+            self._pending.remove(request)
+            if was_active and self._pending:
+                self._send_read(self._pending[0])
+
+    def handle_report(self, report):
+        """
+        Extract memory read replies from a Wiimote report.
+        """
+        _decode_report(self, 'memory', report)
+
+    def _decode(self, report, offset, length):
+        """
+        Decode a memory read reply starting at the size/error byte at `offset`.
+        Usually gets called by the Wiimote CommunicationHandler object.
+        """
+        error = (report[offset] & 0x0f)
+        num_bytes_received = ((report[offset] >> 4) & 0x0f) + 1
+        data_address = (report[offset + 1] << 8) + report[offset + 2]
+        with self._lock:
+            if not self._pending:
+                _debug("Unexpected memory read reply")
+                return
+            request = self._pending[0]
+            if error == 0:
+                # replies to a request that timed out may still arrive
+                if data_address != (request.address + len(request.data)) & 0xffff:
+                    _debug("Discarding memory read reply for address 0x%04x" % data_address)
+                    return
+                data_start = offset + 3
+                request.data.extend(report[data_start:data_start + num_bytes_received])
+                if len(request.data) < request.amount:
+                    return
+                del request.data[request.amount:]  # never more than requested
+            self._pending.popleft()
+            if self._pending:
+                self._send_read(self._pending[0])
+        request._complete(error or None)
+
+    def _decode_ack(self, report, offset, length):
+        """
+        Decode the acknowledgement of an output report (report number and error code).
+        Usually gets called by the Wiimote CommunicationHandler object.
+        """
+        rpt_type, error = report[offset], report[offset + 1]
+        if rpt_type != Memory.RPT_WRITE:
+            if error != 0:
+                _debug("Error condition %x received for output report 0x%02x" % (error, rpt_type))
+            return
+        with self._ack_condition:
+            if self._writes_outstanding > 0:
+                self._writes_outstanding -= 1
+            if error != 0:
+                self._write_error = error
+            self._ack_condition.notify_all()
+
+
+class Extension(object):
+    """
+    Represents the extension port of the Wiimote (Nunchuk, Classic Controller, ...).
+    Extension data is not interpreted yet, the raw bytes as sent by the
+    Wiimote are provided instead.
+    """
+
+    def __init__(self, wiimote):
+        self._wiimote = wiimote
+        self._com = wiimote._com
+        self._state = b''
+        self._callbacks = []
+        self._enabled = False
+
+    def __len__(self):
+        return len(self._state)
+
+    def __repr__(self):
+        return repr(self._state)
+
+    def __getitem__(self, idx):
+        if not self._enabled:
+            _auto_enable(self)
+        return self._state[idx]
+
+    def enable(self):
+        """
+        Request extension data from the Wiimote.
+        Happens automatically when values are read or when registering a callback.
+        """
+        self._enabled = True
+        _update_or_undo(self._wiimote, self._undo_enable)
+
+    def _undo_enable(self):
+        self._enabled = False
+
+    def disable(self):
+        self._enabled = False
+        self._wiimote._update_report_mode()
+
+    def in_use(self):
+        return self._enabled or bool(self._callbacks)
+
+    def register_callback(self, func, policy=None, maxsize=64):
+        """
+        Register a callback function `func` that gets called every time
+        when new extension data is transmitted from the Wiimote.
+        The raw extension bytes are passed to the callback function.
+        If `policy` is given (see `Subscription`), `func` is called from a
+        worker thread of the Wiimote's `CallbackDispatcher` with up to
+        `maxsize` events queued.
+        """
+        _add_callback(self._callbacks, self._wiimote, func, policy, maxsize)
+        _update_or_undo(self._wiimote, lambda: _remove_callback(self._callbacks, func))
+
+    def unregister_callback(self, func):
+        """
+        Unregister a callback function `func` that has been previously registered.
+        """
+        _remove_callback(self._callbacks, func)
+        self._wiimote._update_report_mode()
+
+    def _notify_callbacks(self):
+        stats = self._com.stats
+        if stats is not None:
+            stats._call(self._callbacks, self._state)
+            return
+        for callback in self._callbacks:
+            callback(self._state)
+
+    def handle_report(self, report):
+        """
+        Extract extension data from a Wiimote report.
+        """
+        _decode_report(self, 'extension', report)
+
+    def _decode(self, report, offset, length):
+        """
+        Store `length` extension bytes starting at `offset`.
+        Usually gets called by the Wiimote CommunicationHandler object.
+        """
+        self._state = bytes(report[offset:offset + length])
+        self._notify_callbacks()
+
+
+class OutputScheduler(threading.Thread):
+    """
+    Sends the output reports of a CommunicationHandler from its own thread,
+    at most `max_rate` reports per second.
+    State reports (LEDs and rumble) are held back for up to `window`
+    seconds, and a newer report of the same type replaces a pending one,
+    so only the latest state gets sent.
+    All other reports (memory access, speaker data, report mode, ...)
+    are sent in the order they were submitted, before any pending state reports.
+    Enable with `WiiMote.enable_output_scheduler()`.
+    """
+
+    STATE_REPORTS = (0x10, 0x11)  # rumble, LEDs
+
+    def __init__(self, com, max_rate=100.0, window=0.02):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.running = True  # already accepts reports before start()
+        self.interval = 1.0 / max_rate
+        self.window = window
+        self.sent = 0
+        self.merged = 0
+        self._com = com
+        self._ordered = collections.deque()
+        self._state = {}  # report ID -> [deadline, report]
+        self._busy = False  # a report taken from the queues is being sent
+        self._cond = threading.Condition()
+        self._next_send = 0.0
+
+    def submit(self, report):
+        """
+        Queues a copy of the complete output `report`.
+        Never blocks, so it can be called from the receive thread.
+        """
+        report = bytearray(report)
+        with self._cond:
+            rpt_id = report[1]
+            if rpt_id in self.STATE_REPORTS:
+                pending = self._state.get(rpt_id)
+                if pending is not None:
+                    pending[1] = report  # keep the deadline of the first report
+                    self.merged += 1
+                    return
+                self._state[rpt_id] = [time.monotonic() + self.window, report]
+            else:
+                self._ordered.append(report)
+            self._cond.notify_all()
+
+    def pending(self):
+        with self._cond:
+            return len(self._ordered) + len(self._state)
+
+    def flush(self, timeout=None):
+        """
+        Sends pending state reports without waiting for the end of their
+        window and blocks until all queued reports have been sent,
+        including the one that is being sent right now.
+        Returns False if that took longer than `timeout` seconds.
+        """
+        with self._cond:
+            for pending in self._state.values():
+                pending[0] = 0.0
+            self._cond.notify_all()
+            return self._cond.wait_for(
+                lambda: not self._busy and (not self.running or not (self._ordered or self._state)),
+                timeout)
+
+    def stop(self):
+        with self._cond:
+            self.running = False
+            self._cond.notify_all()
+
+    def run(self):
+        while True:
+            with self._cond:
+                report = self._next_report()
+                if report is None:
+                    return
+                self._busy = True
+            try:
+                self._com._transmit(report)
+            except (OSError, bluetooth.BluetoothError):
+                _debug("Could not send output report")
+                self.stop()
+            with self._cond:
+                self._busy = False
+                self.sent += 1
+                self._cond.notify_all()
+
+    def _next_report(self):
+        """
+        Waits until the next report is due and returns it, or None after stop().
+        Needs to be called with `_cond` held.
+        """
+        while self.running:
+            now = time.monotonic()
+            if self._ordered:
+                due = self._next_send
+            elif self._state:
+                due = max(self._next_send, min(d for d, _ in self._state.values()))
+            else:
+                self._cond.wait()
+                continue
+            if due > now:
+                self._cond.wait(due - now)
+                continue
+            if self._ordered:
+                report = self._ordered.popleft()
+                # every report carries the current rumble bit
+                if self._state.pop(CommunicationHandler.RPT_RUMBLE, None) is not None:
+                    self.merged += 1
+            else:
+                rpt_id = min(self._state, key=lambda k: self._state[k][0])
+                report = self._state.pop(rpt_id)[1]
+            self._next_send = max(now, self._next_send) + self.interval
+            return report
+        return None
+
+
+class CommunicationHandler(threading.Thread):
+
+    MODE_DEFAULT = 0x30
+    MODE_ACC = 0x31
+    MODE_ACC_IR = 0x33
+
+    RPT_RUMBLE = 0x10
+    RPT_LED = 0x11
+    RPT_REPORT_MODE = 0x12
+    RPT_STATUS_REQ = 0x15
+
+    def __init__(self, wiimote, sockets=None):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.rumble = False  # rumble always
+        self.wiimote = wiimote
+        self.btaddr = wiimote.btaddr
+        self.model = wiimote.model
+        self.reporting_mode = self.MODE_DEFAULT
+        if sockets is not None:  # already connected, e.g. to a VirtualWiimote
+            self._controlsocket, self._datasocket = sockets
+        else:
+            self._controlsocket = bluetooth.BluetoothSocket(bluetooth.L2CAP)
+            self._controlsocket.connect((self.btaddr, 17))
+            self._datasocket = bluetooth.BluetoothSocket(bluetooth.L2CAP)
+            self._datasocket.connect((self.btaddr, 19))
+        if self.model == 'Nintendo RVL-CNT-01':
+            self._sendsocket = self._controlsocket
+            self._CMD_SET_REPORT = 0x52
+        elif self.model == 'Nintendo RVL-CNT-01-TR':
+            self._sendsocket = self._datasocket
+            self._CMD_SET_REPORT = 0xa2
+        else:
+            raise Exception("unknown model")
+        # the receive loop blocks in select() until either a report arrives
+        # or stop() writes to this pipe
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        self._wakeup_lock = threading.Lock()  # guards the pipe against _dispose()
+        self._wakeup_closed = False
+        self.running = False
+        self.latency = LatencyStats()
+        self.unknown_reports = 0
+        self.report_time = 0.0  # time.monotonic() when the current report arrived
+        self._dispatch = None
+        self._sensors = None
+        # (sequence number, time, button mask, accelerometer, IR) after the
+        # latest report, see WiiMote.snapshot()
+        self._published = None
+        self._seq = 0
+        self.lazy = False  # see WiiMote.set_lazy_decoding()
+        self._hub = None
+        self._recorder = None
+        self._scheduler = None
+        self.stats = None  # DeviceStats, if enabled
+        # reports are received into this buffer and decoded in place
+        self._buffer = bytearray(32)
+        self._view = memoryview(self._buffer)
+        self._recv_socket = None  # stdlib socket sharing the data socket's connection
+        self._recv_into = self._make_recv_into()
+        # prebuilt output reports for frequent requests, only the payload
+        # is patched before sending
+        cmd = self._CMD_SET_REPORT
+        self._send_lock = threading.Lock()
+        self._rpt_rumble = bytearray((cmd, self.RPT_RUMBLE, 0x00))
+        self._rpt_leds = bytearray((cmd, self.RPT_LED, 0x00))
+        self._rpt_report_mode = bytearray((cmd, self.RPT_REPORT_MODE, 0x00, 0x00))
+        self._rpt_read = bytearray((cmd, Memory.RPT_READ) + (0x00,) * 6)
+        self._rpt_write = bytearray((cmd, Memory.RPT_WRITE) + (0x00,) * 21)
+        self._rpt_speaker = bytearray((cmd, Speaker.RPT_SPKR_PLAY) + (0x00,) * 21)
+        self.set_report_mode(self.MODE_DEFAULT)
+
+    def _send(self, *bytes_to_send, signed=False):
+        """
+        Sends an output report given as a report ID followed by payload bytes
+        (integers or lists of integers).
+        """
+        if DEBUG:
+            _debug("sending " + str(bytes_to_send))
+        report = bytearray((self._CMD_SET_REPORT,))
+        for item in bytes_to_send:
+            if type(item) is int:
+                report.append(item & 0xff if signed else item)
+            else:
+                report.extend(b & 0xff if signed else b for b in _flatten(item))
+        with self._send_lock:
+            self._send_report(report)
+
+    def _send_report(self, report):
+        """
+        Sends a complete output report, or queues a copy of it if an
+        OutputScheduler is enabled.
+        Needs to be called with `_send_lock` held for prebuilt reports.
+        """
+        scheduler = self._scheduler
+        if scheduler is not None:
+            scheduler.submit(report)
+        else:
+            self._transmit(report)
+
+    def _transmit(self, report):
+        """
+        Sets the rumble bit of a complete output report and sends it.
+        """
+        report[2] = (report[2] & 0xfe) | self.rumble
+        self._sendsocket.send(report)
+        if self.stats is not None:
+            self.stats.reports_sent += 1
+
+    def enable_scheduler(self, max_rate=100.0, window=0.02):
+        """
+        Starts sending all output reports through an OutputScheduler.
+        """
+        self.disable_scheduler()
+        scheduler = OutputScheduler(self, max_rate, window)
+        scheduler.start()
+        self._scheduler = scheduler
+        return scheduler
+
+    def disable_scheduler(self):
+        """
+        Sends output reports directly again. Reports still queued in the
+        scheduler are sent before it stops.
+        """
+        scheduler = self._scheduler
+        if scheduler is None:
+            return
+        scheduler.flush()
+        # no direct sends may overtake reports queued in the meantime
+        with self._send_lock:
+            scheduler.flush()
+            self._scheduler = None
+        scheduler.stop()
+
+    def send_leds(self, led_byte):
+        with self._send_lock:
+            self._rpt_leds[2] = led_byte
+            self._send_report(self._rpt_leds)
+
+    def send_read_request(self, address, amount, eeprom=False):
+        if not 0 <= address <= 0xffffff:
+            raise ValueError("Memory address needs to fit into 24 bits")
+        if not 0 <= amount <= 0xffff:
+            raise ValueError("Read size needs to fit into 16 bits")
+        with self._send_lock:
+            report = self._rpt_read
+            # control/EEPROM flag, followed by the 24-bit address
+            struct.pack_into('>IH', report, 2, ((0x00 if eeprom else 0x04) << 24) | address, amount)
+            self._send_report(report)
+
+    def send_write_request(self, address, data, eeprom=False):
+        """
+        Sends a single write request with up to 16 bytes of `data`.
+        """
+        if not 0 <= address <= 0xffffff:
+            raise ValueError("Memory address needs to fit into 24 bits")
+        with self._send_lock:
+            report = self._rpt_write
+            struct.pack_into('>IB16s', report, 2, ((0x00 if eeprom else 0x04) << 24) | address,
+                             len(data), bytes(data))
+            self._send_report(report)
+
+    def send_speaker_data(self, data):
+        """
+        Sends up to 20 bytes of encoded audio data to the speaker.
+        """
+        with self._send_lock:
+            report = self._rpt_speaker
+            struct.pack_into('>B20s', report, 2, len(data) << 3, bytes(data))
+            self._send_report(report)
+
+    def run(self):
+        self.running = True
+        selector = selectors.DefaultSelector()
+        selector.register(self._datasocket, selectors.EVENT_READ)
+        selector.register(self._wakeup_r, selectors.EVENT_READ)
+        while self.running:
+            for key, _ in selector.select():
+                if key.fileobj == self._wakeup_r:
+                    self.running = False
+                    break
+                self._receive()
+        selector.close()
+        self._dispose()
+
+    def _receive(self):
+        """
+        Reads one report from the data socket and decodes it right away.
+        Only called when the socket is readable, so recv() does not block.
+        """
+        try:
+            num_bytes = self._recv_into(self._buffer)
+        except (bluetooth.BluetoothError, OSError):  # OSError: stdlib socket
+            _debug("BluetoothError while waiting for data")
+            if self.stats is not None:
+                self.stats.receive_errors += 1
+            return
+        self.report_time = received = time.monotonic()
+        if num_bytes < 2:  # disconnect!
+            self.running = False
+        else:
+            recorder = self._recorder
+            if recorder is not None:
+                recorder.append(received, self._view, num_bytes)
+            # decoders only access their own offsets, so no need to
+            # slice off the unused end of the buffer
+            stats = self.stats
+            if stats is None:
+                self._handle(self._view)
+            else:
+                stats._received(self._buffer[1], received)
+                callback_time = stats.callback_time.total
+                start = time.perf_counter()
+                self._handle(self._view)
+                stats.decode_time.add(time.perf_counter() - start -
+                                      (stats.callback_time.total - callback_time))
+            self.latency.add(time.monotonic() - received)
+
+    def _make_recv_into(self):
+        """
+        Returns a recv_into() function for the data socket.
+        PyBluez sockets do not provide one, so their file descriptor is
+        duplicated into a stdlib socket (AF_BLUETOOTH is supported on Linux).
+        If that is not possible, reports are received with recv() and copied.
+        """
+        sock = self._datasocket
+        if hasattr(sock, 'recv_into'):
+            return sock.recv_into
+        try:
+            fd = os.dup(sock.fileno())
+        except (AttributeError, OSError):
+            return self._recv_copy
+        try:
+            self._recv_socket = socket.socket(fileno=fd)
+        except OSError:
+            os.close(fd)
+            return self._recv_copy
+        return self._recv_socket.recv_into
+
+    def _recv_copy(self, buffer):
+        """
+        Fallback for sockets that do not support recv_into() and cannot be
+        wrapped in a stdlib socket. Allocates a bytes object per report.
+        """
+        data = self._datasocket.recv(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+    def in_receive_thread(self):
+        """
+        Returns True if called from the thread that decodes incoming reports.
+        Code running there must not wait for replies from the Wiimote.
+        """
+        if self._hub is not None:
+            return self._hub.in_receive_thread()
+        return threading.current_thread() is self
+
+    def attach(self, hub):
+        """
+        Lets `hub` receive this Wiimote's reports instead of starting a thread.
+        """
+        self._hub = hub
+        self.running = True
+        hub.add(self)
+
+    def stop(self):
+        """
+        Stops the receive loop immediately and closes the connection.
+        """
+        self.running = False
+        if self._hub is not None:
+            self._hub.remove(self)
+        else:
+            with self._wakeup_lock:
+                if not self._wakeup_closed:
+                    os.write(self._wakeup_w, b'\x00')
+
+    def _dispose(self):
+        scheduler, self._scheduler = self._scheduler, None
+        if scheduler is not None:
+            scheduler.stop()
+        if self._recv_socket is not None:
+            self._recv_socket.close()
+        self._datasocket.close()
+        self._controlsocket.close()
+        with self._wakeup_lock:
+            if not self._wakeup_closed:
+                self._wakeup_closed = True
+                os.close(self._wakeup_r)
+                os.close(self._wakeup_w)
+        self.running = False
+
+    def set_report_mode(self, mode):
+        self.reporting_mode = mode
+        with self._send_lock:
+            self._rpt_report_mode[3] = mode
+            self._send_report(self._rpt_report_mode)
+
+    def _init_dispatch(self):
+        """
+        Precomputes a table of bound decoder methods for every report type
+        so that _handle() needs only a single lookup per report.
+        In lazy decoding mode, sensors without callbacks or history only
+        store their raw data (`_store*` instead of `_decode*`).
+        Needs to be called after all sensors have been assigned to the Wiimote,
+        and again whenever callbacks or histories change.
+        The new table replaces the old one in a single assignment, so the
+        receive thread does not need to be stopped.
+        """
+        wiimote = self.wiimote
+        self._sensors = (wiimote.buttons, wiimote.accelerometer, wiimote.ir)
+        dispatch = [None] * 256
+        for rpt_type, entries in INPUT_REPORTS.items():
+            # received data starts with the transaction header (0xa1),
+            # followed by the report ID, so shift all offsets by one
+            dispatch[rpt_type] = tuple(
+                (self._decoder(sensor, decoder), offset + 1, length)
+                for sensor, decoder, offset, length in entries)
+        self._dispatch = dispatch
+
+    def _decoder(self, sensor, decoder):
+        sensor = getattr(self.wiimote, sensor)
+        if self.lazy and hasattr(sensor, '_load') and not sensor._needs_decoding():
+            # interleaved reports need to be reassembled right away
+            store = getattr(sensor, '_store' + decoder[len('_decode'):], None)
+            if store is not None:
+                return store
+        return getattr(sensor, decoder)
 
-    def disable(self):
-        pass
+    def _handle(self, bytes_read):
+        if DEBUG:
+            _debug("received " + str(bytes(bytes_read)))
+        # assert(bytes_read[0] == self._CMD_SET_REPORT + 1)
+        decoders = self._dispatch[bytes_read[1]]
+        if decoders is None:
+            self.unknown_reports += 1
+            _debug("unknown report type 0x%02x" % bytes_read[1])
+            return
+        for decode, offset, length in decoders:
+            decode(bytes_read, offset, length)
+        # the decoders replace the state of their sensors instead of changing
+        # it, so these references stay valid. In lazy decoding mode, the raw
+        # data is the latest state.
+        buttons, acc, ir = self._sensors
+        self._seq += 1
+        self._published = (self._seq, self.report_time, buttons._mask,
+                           acc._raw or acc._state, ir._raw or ir._state)
 
-    def get_state(self):
-        return self._state
+    def set_rumble(self, state):
+        self.rumble = bool(state)
+        # the rumble bit is part of every report, the rumble report carries nothing else
+        with self._send_lock:
+            self._send_report(self._rpt_rumble)
 
-    def set_sensitivity(self, sensitivity):
-        self.set_mode_sensitivity(self._mode, sensitivity)
 
-    def set_mode(self, mode):
-        self.set_mode_sensitivity(mode, self._sensitivity)
+class WiiMoteHub(threading.Thread):
+    """
+    Receives and decodes the reports of any number of Wiimotes in a single
+    thread, waiting on all of their data sockets with one selector.
+    Pass the hub to `connect()` for every Wiimote that it should serve.
+    The hub thread is started with the first Wiimote added.
+    """
 
-    def register_callback(self, func):
-        self._callbacks.append(func)
+    def __init__(self):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.running = False
+        self._selector = selectors.DefaultSelector()
+        # the selector may only be changed by the hub thread, so other threads
+        # queue their changes and wake it up through this pipe
+        self._wakeup_r, self._wakeup_w = os.pipe()
+        os.set_blocking(self._wakeup_r, False)
+        self._selector.register(self._wakeup_r, selectors.EVENT_READ)
+        self._changes = collections.deque()
+        # guards starting, stopping and closing the wakeup pipe
+        self._lock = threading.Lock()
+        self._stopped = False
+        self._closed = False
 
-    def unregister_callback(self, func):
-        if func in self._callbacks:
-            self._callbacks.remove(func)
+    def __len__(self):
+        return len(self._selector.get_map()) - 1
 
-    def _notify_callbacks(self):
-        for callback in self._callbacks:
-            callback(self._state)
+    def in_receive_thread(self):
+        return threading.current_thread() is self
 
-    def handle_report(self, report):
-        assert report[0] in self.SUPPORTED_REPORTS
-        # only extended mode for now!
-        ir_data = report[6:]
-        self._state = []
-        for ir_obj in range(4):
-            data = ir_data[ir_obj*3:(ir_obj+1)*3]
-            x = data[0] + ((data[2] & 0b00110000) << 4)
-            y = data[1] + ((data[2] & 0b11000000) << 2)
-            size = data[2] & 0b00001111
-            if size != 0:
-                self._state.append({'id': ir_obj, 'x': x, 'y': y, 'size': size})
-        self._notify_callbacks()
+    def add(self, com):
+        """
+        Start serving the CommunicationHandler `com`.
+        Usually gets called by `CommunicationHandler.attach()`.
+        """
+        with self._lock:
+            if self._stopped:
+                raise RuntimeError("WiiMoteHub has been stopped, create a new one")
+            if not self.running:
+                self.running = True
+                self.start()
+            self._changes.append((True, com))
+            self._wakeup()
+
+    def remove(self, com):
+        """
+        Stop serving `com` and close its connection.
+        Does nothing once the hub has been stopped, as stopping the hub
+        closes all connections anyway.
+        """
+        with self._lock:
+            if self._stopped:
+                return
+            self._changes.append((False, com))
+            self._wakeup()
 
+    def stop(self):
+        """
+        Disconnects all Wiimotes and ends the hub thread.
+        """
+        with self._lock:
+            if self._stopped:
+                return
+            self._stopped = True
+            if not self.running:  # never started
+                self._close()
+                return
+            self.running = False
+            self._wakeup()
+
+    def _wakeup(self):
+        """
+        Wakes up the hub thread. Needs to be called with `_lock` held.
+        """
+        if not self._closed:
+            os.write(self._wakeup_w, b'\x00')
 
-class Memory(object):
+    def _close(self):
+        """
+        Closes selector and wakeup pipe. Needs to be called with `_lock` held.
+        """
+        self._closed = True
+        self._selector.close()
+        os.close(self._wakeup_r)
+        os.close(self._wakeup_w)
 
-    RPT_READ = 0x17
-    RPT_WRITE = 0x16
+    def _apply_changes(self):
+        try:
+            os.read(self._wakeup_r, 512)
+        except BlockingIOError:
+            pass
+        while self._changes:
+            add, com = self._changes.popleft()
+            if add:
+                self._selector.register(com._datasocket, selectors.EVENT_READ, com)
+            elif com._datasocket in self._selector.get_map():
+                self._disconnect(com)
+
+    def _disconnect(self, com):
+        self._selector.unregister(com._datasocket)
+        com._dispose()
+
+    def run(self):
+        while self.running:
+            for key, _ in self._selector.select():
+                com = key.data
+                if com is None:  # wakeup pipe
+                    self._apply_changes()
+                    continue
+                if not com.running:  # already being removed
+                    continue
+                com._receive()
+                if not com.running:  # disconnected
+                    self._disconnect(com)
+        self._apply_changes()
+        for key in list(self._selector.get_map().values()):
+            if key.data is not None:
+                self._disconnect(key.data)
+        with self._lock:
+            self._close()
+
+
+class AsyncioHub(object):
+    """
+    Lets an asyncio event loop receive and decode the reports of Wiimotes,
+    just like `WiiMoteHub` does with a thread of its own.
+    Needs to be created from within the running event loop.
+    """
 
-    SUPPORTED_REPORTS = [0x21]
+    def __init__(self, loop=None):
+        self.loop = loop or asyncio.get_running_loop()
+        self._thread = threading.current_thread()
+        self._coms = set()
 
-    MAX_ADDRESS = 0x16FF
+    def __len__(self):
+        return len(self._coms)
 
-    def __init__(self, wiimote):
+    def in_receive_thread(self):
+        return threading.current_thread() is self._thread
+
+    def add(self, com):
+        self.loop.call_soon_threadsafe(self._add, com)
+
+    def remove(self, com):
+        self.loop.call_soon_threadsafe(self._remove, com)
+
+    def _add(self, com):
+        self._coms.add(com)
+        self.loop.add_reader(com._datasocket.fileno(), self._receive, com)
+
+    def _remove(self, com):
+        if com in self._coms:
+            self._coms.remove(com)
+            self.loop.remove_reader(com._datasocket.fileno())
+            com._dispose()
+
+    def _receive(self, com):
+        com._receive()
+        if not com.running:  # disconnected
+            self._remove(com)
+
+
+class AsyncStream(object):
+    """
+    Async iterator over the events of a sensor (see `AsyncWiiMote`).
+    Needs to be created from within the event loop.
+    Events are buffered in a queue of `maxsize` entries; if the consumer
+    falls behind, the oldest events are dropped and counted in `dropped`.
+    """
+
+    _CLOSED = object()
+
+    def __init__(self, sensor, loop, maxsize=64):
+        self._sensor = sensor
+        self._loop = loop
+        self._queue = asyncio.Queue(maxsize)
+        self._loop_thread = threading.current_thread()
+        self.dropped = 0
+        sensor.register_callback(self._on_event)
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        event = await self._queue.get()
+        if event is self._CLOSED:
+            raise StopAsyncIteration
+        return event
+
+    def close(self):
+        """
+        Stops receiving events; iteration ends after all queued events.
+        """
+        self._sensor.unregister_callback(self._on_event)
+        self._loop.call_soon_threadsafe(self._put, self._CLOSED)
+
+    def _on_event(self, event):
+        if threading.current_thread() is self._loop_thread:
+            self._put(event)
+        else:  # callback running on a receive thread
+            self._loop.call_soon_threadsafe(self._put, event)
+
+    def _put(self, event):
+        if self._queue.full():
+            self._queue.get_nowait()
+            self.dropped += 1
+        self._queue.put_nowait(event)
+
+
+async def connect_async(btaddr, model=None):
+    """
+    Coroutine that connects to the Wiimote at *btaddr* and returns an
+    `AsyncWiiMote` whose reports are received by the running event loop.
+    """
+    loop = asyncio.get_running_loop()
+    hub = AsyncioHub(loop)
+    # connecting and configuring the Wiimote blocks until the Wiimote has
+    # replied, while replies are received by the event loop
+    wiimote = await loop.run_in_executor(None, connect, btaddr, model, hub)
+    return AsyncWiiMote(wiimote, loop)
+
+
+class AsyncWiiMote(object):
+    """
+    asyncio front end for a `WiiMote`, created with `connect_async()`.
+    The underlying WiiMote is available as `wiimote`; its callbacks are
+    called from the event loop.
+    Example:
+        wm = await wiimote.connect_async(btaddr)
+        async for changed in wm.buttons():
+            print(changed)
+    """
+
+    def __init__(self, wiimote, loop):
         self.wiimote = wiimote
-        self._com = wiimote._com
-        self._request_in_progress = False
-        self._bytes_requested = 0
-        self._reply_buffer = []
+        self.loop = loop
 
-    def write(self, address, data, eeprom=False):
-        address_bytes = _val_to_byte_list(address, 3, big_endian=True)
-        bytes_to_send = _flatten(data)
-        amount = len(bytes_to_send)
-        if eeprom and address + amount > Memory.MAX_ADDRESS:
-            raise ValueError("EEPROM address needs to be between 0x0000 and 0x16FF")
-        if address < 0:
-            raise ValueError("Memory address needs to be greater than 0x0000")
-        # to do: send larger blocks in multiple 16-byte requests instead of failing
-        if amount > 16:
-            raise ValueError("A maximum of 16 bytes can be sent per function call")
-        amount_byte = _val_to_byte_list(amount, 1, big_endian=True)
-        bytes_to_send = _add_padding(bytes_to_send, 16)
-        control_or_eeprom = 0x00 if eeprom else 0x04
-        self._com._send(Memory.RPT_WRITE, control_or_eeprom, address_bytes, amount_byte, bytes_to_send)
-
-    def read(self, address, amount, eeprom=False):
-        if self._request_in_progress:
-            raise RuntimeError("Memory read already in progress.")
-        if eeprom and address + amount > Memory.MAX_ADDRESS:
-            raise ValueError("EEPROM address needs to be between 0x0000 and 0x16FF")
-        if address < 0:
-            raise ValueError("Memory address needs to be greater than 0x0000")
-        self._bytes_remaining = amount
-        address_bytes = _val_to_byte_list(address, 3, big_endian=True)
-        amount_bytes = _val_to_byte_list(amount, 2, big_endian=True)
-        control_or_eeprom = 0x00 if eeprom else 0x04
-        self._request_in_progress = True
-        self._reply_buffer = []
-        self._com._send(Memory.RPT_READ, control_or_eeprom, address_bytes, amount_bytes)
-        # now wait until handle() has filled our reply buffer
-        while self._request_in_progress:
-            time.sleep(0.01)
-        return self._reply_buffer
+    def buttons(self, maxsize=64):
+        """
+        Returns an `AsyncStream` of lists of changed buttons.
+        """
+        return AsyncStream(self.wiimote.buttons, self.loop, maxsize)
 
-    def handle_report(self, report):
-        if report[0] not in Memory.SUPPORTED_REPORTS:  # interleaved modes
-            raise NotImplementedError("can not handle this report")
-        error = (report[3] & 0x0f)
-        if error != 0:
-            raise RuntimeError("Error condition %x received during memory read!" % error)
-        num_bytes_received = ((report[3] >> 4) & 0x0f) + 1
-        data_bytes = report[6:][:num_bytes_received]
-        self._reply_buffer += data_bytes
-        self._bytes_remaining -= num_bytes_received
-        if self._bytes_remaining < 0:
-            raise RuntimeError("Memory read received more data than requested!")
-        elif self._bytes_remaining == 0:
-            self._request_in_progress = False
+    def accelerometer(self, maxsize=64):
+        """
+        Returns an `AsyncStream` of accelerometer values.
+        """
+        return AsyncStream(self.wiimote.accelerometer, self.loop, maxsize)
 
+    def ir(self, maxsize=64):
+        """
+        Returns an `AsyncStream` of IR objects.
+        """
+        return AsyncStream(self.wiimote.ir, self.loop, maxsize)
 
-class CommunicationHandler(threading.Thread):
+    async def read_memory(self, address, amount, eeprom=False, timeout=Memory.DEFAULT_TIMEOUT):
+        """
+        Coroutine version of `Memory.read()`.
+        """
+        future = self.loop.create_future()
 
-    MODE_DEFAULT = 0x30
-    MODE_ACC = 0x31
-    MODE_ACC_IR = 0x33
+        def done(request):
+            self.loop.call_soon_threadsafe(_set_future, future, request)
+        request = self.wiimote.memory.request_read(address, amount, eeprom)
+        request.add_done_callback(done)
+        try:
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            self.wiimote.memory._cancel(request)
+            raise TimeoutError("Memory read at 0x%06x timed out" % address)
 
-    RPT_STATUS_REQ = 0x15
+    async def write_memory(self, address, data, eeprom=False, timeout=Memory.DEFAULT_TIMEOUT):
+        """
+        Coroutine version of `Memory.write()`.
+        Waits for acknowledgements in an executor thread, as they are received
+        by the event loop.
+        """
+        await self.loop.run_in_executor(None, self.wiimote.memory.write,
+                                        address, data, eeprom, timeout)
 
-    def __init__(self, wiimote):
+    def disconnect(self):
+        self.wiimote.disconnect()
+
+
+def _set_future(future, request):
+    if future.done():  # timed out
+        return
+    if request.error is not None:
+        future.set_exception(RuntimeError("Error condition %x received during memory read!" %
+                                          request.error))
+    else:
+        future.set_result(request.data)
+
+
+# Report logs consist of a header and fixed-size records, each holding
+# the receive time (nanoseconds since the start of the recording),
+# the length of the raw report data, and the data itself (zero-padded).
+# Raw report data starts with the transaction header (0xa1), followed by the
+# report ID.
+LOG_MAGIC = b'WMRAWLOG'
+LOG_VERSION = 1
+LOG_HEADER = struct.Struct('<8sHHd12x')  # magic, version, record size, start (epoch)
+LOG_RECORD = struct.Struct('<QB23s')  # time (ns), length, data
+LOG_MAX_REPORT_SIZE = 23
+
+
+class ReportRecorder(object):
+    """
+    Appends raw reports with their receive timestamps to a report log file.
+    Usually used through `WiiMote.start_recording()`.
+    close() may be called from any thread; reports appended afterwards
+    are ignored.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        self.count = 0
+        self._start = None
+        self._record = bytearray(LOG_RECORD.size)
+        self._lock = threading.Lock()
+        self._file = open(path, 'wb')
+        self._file.write(LOG_HEADER.pack(LOG_MAGIC, LOG_VERSION, LOG_RECORD.size, time.time()))
+        self._file.flush()  # lets ReportLog open the file while recording
+
+    def append(self, timestamp, data, length):
+        """
+        Append the first `length` bytes of `data`, received at `timestamp`
+        (time.monotonic()).
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            if self._start is None:
+                self._start = timestamp
+            length = min(length, LOG_MAX_REPORT_SIZE)
+            record = self._record
+            LOG_RECORD.pack_into(record, 0, int((timestamp - self._start) * 1e9), length, b'')
+            record[9:9 + length] = data[:length]
+            self._file.write(record)
+            self.count += 1
+
+    def close(self):
+        with self._lock:
+            if self._file is not None:
+                self._file.close()
+                self._file = None
+
+
+class ReportLog(object):
+    """
+    Read-only access to a report log written by `ReportRecorder`.
+    The file is memory-mapped, so opening even very long recordings is
+    instant and records are only read from disk when accessed.
+    Iterating over a log yields (time, data) tuples, where time is the
+    receive time in seconds since the start of the recording and data is a
+    memoryview of the raw report.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._mmap = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, record_size, self.start_time = LOG_HEADER.unpack_from(self._mmap, 0)
+        if magic != LOG_MAGIC or version != LOG_VERSION or record_size != LOG_RECORD.size:
+            self._mmap.close()
+            raise ValueError("%s is not a report log" % path)
+        self._view = memoryview(self._mmap)
+        # ignore an incomplete last record (e.g. from an interrupted recording)
+        self._count = (len(self._mmap) - LOG_HEADER.size) // LOG_RECORD.size
+
+    def __len__(self):
+        return self._count
+
+    def __getitem__(self, idx):
+        if not 0 <= idx < self._count:
+            raise IndexError("record index out of range")
+        offset = LOG_HEADER.size + idx * LOG_RECORD.size
+        timestamp, length = struct.unpack_from('<QB', self._view, offset)
+        return timestamp / 1e9, self._view[offset + 9:offset + 9 + length]
+
+    def __iter__(self):
+        for idx in range(self._count):
+            yield self[idx]
+
+    def records(self):
+        """
+        Returns a memoryview of all records, e.g. for batch processing.
+        """
+        end = LOG_HEADER.size + self._count * LOG_RECORD.size
+        return self._view[LOG_HEADER.size:end]
+
+    def times(self):
+        """
+        Returns the receive times of all reports (in seconds since the start
+        of the recording) as a NumPy array.
+        """
+        if np is None:
+            raise RuntimeError("NumPy is required for batch processing")
+        records = np.frombuffer(self.records(), dtype=np.uint8).reshape(-1, LOG_RECORD.size)
+        return records[:, :8].copy().view('<u8')[:, 0] / 1e9
+
+    def decode(self):
+        """
+        Decodes all reports at once, see `decode_batch()`.
+        """
+        # report ID follows the transaction header at the start of the data
+        return decode_batch(self.records(), LOG_RECORD.size, 10)
+
+    def close(self):
+        self._view.release()
+        self._mmap.close()
+
+
+class ReportReplayer(threading.Thread):
+    """
+    Feeds the reports of a `ReportLog` into the decoders of `wiimote` with the
+    recorded timing, `speed` times faster (or as fast as possible if `speed`
+    is None). Call `run()` to replay on the current thread or `start()` to
+    replay in the background.
+    """
+
+    def __init__(self, log, wiimote, speed=1.0):
         threading.Thread.__init__(self)
         self.daemon = True
-        self.rumble = False  # rumble always
+        self.log = log
         self.wiimote = wiimote
-        self.btaddr = wiimote.btaddr
-        self.model = wiimote.model
-        self.reporting_mode = self.MODE_DEFAULT
-        self._controlsocket = bluetooth.BluetoothSocket(bluetooth.L2CAP)
-        self._controlsocket.connect((self.btaddr, 17))
-        self._datasocket = bluetooth.BluetoothSocket(bluetooth.L2CAP)
-        self._datasocket.connect((self.btaddr, 19))
-        if self.model == 'Nintendo RVL-CNT-01':
-            self._sendsocket = self._controlsocket
-            self._CMD_SET_REPORT = 0x52
-        elif self.model == 'Nintendo RVL-CNT-01-TR':
-            self._sendsocket = self._datasocket
-            self._CMD_SET_REPORT = 0xa2
-        else:
-            raise Exception("unknown model")
-        try:
-            self._datasocket.settimeout(1)
-        except NotImplementedError:
-            print("socket timeout not implemented with this bluetooth module")
-        self.set_report_mode(self.MODE_ACC_IR)
+        self.speed = speed
+        self.running = False
+        self.count = 0
 
-    def _send(self, *bytes_to_send, signed=False):
-        _debug("sending " + str(bytes_to_send))
-        data_str = self._CMD_SET_REPORT.to_bytes(1, 'big')
-        bytes_to_send = _flatten(bytes_to_send)
-        bytes_to_send[1] |= int(self.rumble)
-        for b in bytes_to_send:
-            data_str += b.to_bytes(1, 'big', signed=signed)
-        self._sendsocket.send(data_str)
+    def stop(self):
+        self.running = False
 
     def run(self):
         self.running = True
-        while self.running:
-            try:
-                data = self._datasocket.recv(32)
-            except bluetooth.BluetoothError:
-                _debug("BluetoothError while waiting for data")
-                continue
-            if len(data) < 2:  # disconnect!
-                self.running = False
+        com = self.wiimote._com
+        start = time.monotonic()
+        for timestamp, data in self.log:
+            if not self.running:
+                break
+            if self.speed:
+                timestamp /= self.speed
+                delay = start + timestamp - time.monotonic()
+                if delay > 0:
+                    time.sleep(delay)
+            com.report_time = start + timestamp
+            com._handle(data)
+            self.count += 1
+        self.running = False
+
+
+def _batch_dtype():
+    return np.dtype([('type', 'u1'),
+                     ('buttons', '<u2'),  # bitmask, see Buttons.BUTTONS
+                     ('accel', '<u2', (3,)),
+                     ('ir', '<u2', (4, 3)),  # x, y, size of each slot
+                     ('has_accel', '?'),
+                     ('has_ir', '?')])
+
+
+def decode_batch(reports, stride, offset=0):
+    """
+    Decodes a buffer of fixed-size raw reports with vectorized NumPy operations
+    instead of passing them through the sensor objects one by one.
+    Each report occupies `stride` bytes with the report ID at `offset`; reports
+    of different types may be mixed.
+    Returns a structured array with one entry per report, holding the report
+    type, button bitmask, accelerometer values, and x/y/size of the four IR
+    slots (empty slots as (1023, 1023, 0)). `has_accel` and `has_ir` tell which
+    reports contained accelerometer and IR data; other values are zero.
+    Interleaved reports (0x3e/0x3f) are not reassembled: each holds two of
+    the four IR slots and no accelerometer values.
+    """
+    if np is None:
+        raise RuntimeError("NumPy is required for batch processing")
+    raw = np.frombuffer(reports, dtype=np.uint8)
+    raw = raw[:len(raw) - len(raw) % stride].reshape(-1, stride)
+    types = raw[:, offset]
+    out = np.zeros(len(raw), dtype=_batch_dtype())
+    out['type'] = types
+    out['ir'][:, :, :2] = 0x3ff
+    for rpt_type in np.unique(types):
+        entries = INPUT_REPORTS.get(int(rpt_type))
+        if entries is None:
+            continue
+        rows = np.nonzero(types == rpt_type)[0]
+        r = raw[rows].astype(np.uint16)
+        for sensor, decoder, off, length in entries:
+            o = offset + off
+            if sensor == 'buttons':
+                out['buttons'][rows] = ((r[:, o] << 8) + r[:, o + 1]) & Buttons.ALL_BUTTONS
+            elif decoder == '_decode' and sensor == 'accelerometer':
+                out['accel'][rows] = np.stack((
+                    (r[:, o + 2] << 2) + ((r[:, o] & 0b01100000) >> 5),
+                    (r[:, o + 3] << 2) + ((r[:, o + 1] & 0b00100000) >> 4),
+                    (r[:, o + 4] << 2) + ((r[:, o + 1] & 0b01000000) >> 5)), axis=1)
+                out['has_accel'][rows] = True
+            elif decoder == '_decode_extended':
+                ir = np.empty((len(rows), 4, 3), dtype=np.uint16)
+                for slot in range(4):
+                    b = r[:, o + slot * 3:o + slot * 3 + 3]
+                    ir[:, slot, 0] = b[:, 0] + ((b[:, 2] & 0b00110000) << 4)
+                    ir[:, slot, 1] = b[:, 1] + ((b[:, 2] & 0b11000000) << 2)
+                    ir[:, slot, 2] = np.where(ir[:, slot, 1] != 0x3ff, b[:, 2] & 0b00001111, 0)
+                out['ir'][rows] = ir
+                out['has_ir'][rows] = True
+            elif decoder == '_decode_basic':
+                ir = np.zeros((len(rows), 4, 3), dtype=np.uint16)
+                for pair in range(2):
+                    b = r[:, o + pair * 5:o + pair * 5 + 5]
+                    ir[:, pair * 2, 0] = b[:, 0] + ((b[:, 2] & 0b00110000) << 4)
+                    ir[:, pair * 2, 1] = b[:, 1] + ((b[:, 2] & 0b11000000) << 2)
+                    ir[:, pair * 2 + 1, 0] = b[:, 3] + ((b[:, 2] & 0b00000011) << 8)
+                    ir[:, pair * 2 + 1, 1] = b[:, 4] + ((b[:, 2] & 0b00001100) << 6)
+                out['ir'][rows] = ir
+                out['has_ir'][rows] = True
+            elif decoder in ('_decode_full_a', '_decode_full_b'):
+                first = 0 if decoder == '_decode_full_a' else 2
+                ir = out['ir'][rows]
+                for slot in range(2):
+                    b = r[:, o + slot * 9:o + slot * 9 + 3]
+                    y = b[:, 1] + ((b[:, 2] & 0b11000000) << 2)
+                    ir[:, first + slot, 0] = b[:, 0] + ((b[:, 2] & 0b00110000) << 4)
+                    ir[:, first + slot, 1] = y
+                    ir[:, first + slot, 2] = np.where(y != 0x3ff, b[:, 2] & 0b00001111, 0)
+                out['ir'][rows] = ir
+                out['has_ir'][rows] = True
+    return out
+
+
+class _VirtualSocket(object):
+    """
+    Socket of a `VirtualWiimote`: received data comes from a local socket,
+    sent data is processed by the VirtualWiimote.
+    """
+
+    def __init__(self, device, sock):
+        self._device = device
+        self._sock = sock
+
+    def send(self, data):
+        self._device._output(data)
+        return len(data)
+
+    def recv(self, num_bytes):
+        return self._sock.recv(num_bytes)
+
+    def recv_into(self, buffer):
+        return self._sock.recv_into(buffer)
+
+    def fileno(self):
+        return self._sock.fileno()
+
+    def close(self):
+        self._sock.close()
+
+
+class VirtualWiimote(object):
+    """
+    Stands in for the Bluetooth connection to a Wiimote, so that a `WiiMote`
+    can be used without hardware, e.g. to replay recordings or for benchmarks.
+    Memory writes are acknowledged and memory reads are answered from an
+    emulated memory (with default accelerometer calibration in the EEPROM).
+    Input reports can be injected with `send_report()`.
+    Use `connect_virtual()` to get a WiiMote connected to it.
+    """
+
+    MODEL = 'Nintendo RVL-CNT-01-TR'
+    BTADDR = '00:00:00:00:00:00'
+
+    def __init__(self):
+        self.eeprom = bytearray(Memory.MAX_ADDRESS + 1)
+        calibration = [0x80, 0x80, 0x80, 0x00, 0x9a, 0x9a, 0x9a, 0x00, 0x00]
+        calibration.append((sum(calibration) + 0x55) & 0xff)
+        self.eeprom[AccelerometerCalibration.EEPROM_ADDRESS:
+                    AccelerometerCalibration.EEPROM_ADDRESS + len(calibration)] = bytes(calibration)
+        self.registers = {}
+        self.output_reports = []
+        self._local, self._remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+        self._control, self._control_remote = socket.socketpair(socket.AF_UNIX, socket.SOCK_SEQPACKET)
+
+    def sockets(self):
+        """
+        Returns (control socket, data socket) for a CommunicationHandler.
+        """
+        return (_VirtualSocket(self, self._control), _VirtualSocket(self, self._local))
+
+    def send_report(self, report):
+        """
+        Sends an input report (starting with the report ID) to the WiiMote.
+        """
+        self._remote.send(b'\xa1' + bytes(report))
+
+    def close(self):
+        self._remote.close()
+        self._control_remote.close()
+
+    def _output(self, data):
+        """
+        Handles an output report (starting with the transaction header) sent by
+        the WiiMote.
+        """
+        self.output_reports.append(bytes(data))
+        rpt_type = data[1]
+        if rpt_type == Memory.RPT_WRITE:
+            address = (data[3] << 16) + (data[4] << 8) + data[5]
+            payload = data[7:7 + data[6]]
+            if data[2] & 0x04:
+                for i, val in enumerate(payload):
+                    self.registers[address + i] = val
             else:
-                self._handle(data)
-            time.sleep(0.001)  # Wiimote: 100 Hz, check ten times as often
-        self._dispose()
+                self.eeprom[address:address + len(payload)] = payload
+            self.send_report([0x22, 0x00, 0x00, Memory.RPT_WRITE, 0x00])
+        elif rpt_type == Memory.RPT_READ:
+            address = (data[3] << 16) + (data[4] << 8) + data[5]
+            amount = (data[6] << 8) + data[7]
+            for start in range(address, address + amount, 16):
+                size = min(16, address + amount - start)
+                if data[2] & 0x04:
+                    chunk = [self.registers.get(a, 0) for a in range(start, start + size)]
+                else:
+                    chunk = list(self.eeprom[start:start + size])
+                self.send_report([0x21, 0x00, 0x00, (size - 1) << 4,
+                                  (start >> 8) & 0xff, start & 0xff] + chunk + [0] * (16 - size))
+
+
+def connect_virtual(device=None, hub=None):
+    """
+    Returns a WiiMote connected to `device` (a new `VirtualWiimote` if None).
+    """
+    if device is None:
+        device = VirtualWiimote()
+    return WiiMote(VirtualWiimote.BTADDR, VirtualWiimote.MODEL, hub, device.sockets())
 
-    def _dispose(self):
-        self._datasocket.close()
-        self._controlsocket.close()
-        self.running = False
 
-    def set_report_mode(self, mode):
-        self.reporting_mode = mode
-        self._send(0x12, 0x00, mode)
+def replay(path, wiimote=None, speed=1.0):
+    """
+    Replays the report log at `path` in the background into `wiimote`
+    (a virtual one if None) and returns the `ReportReplayer`.
+    The WiiMote is available as the replayer's `wiimote` attribute.
+    """
+    if wiimote is None:
+        wiimote = connect_virtual()
+    replayer = ReportReplayer(ReportLog(path), wiimote, speed)
+    replayer.start()
+    return replayer
 
-    def _handle(self, bytes_read):
-        _debug("received " + str(bytes_read))
-        # assert(bytes_read[0] == self._CMD_SET_REPORT + 1)
-        rpt_type = bytes_read[1]
-        # all reports include button data
-        self.wiimote.buttons.handle_report(bytes_read[1:])
-        if rpt_type in Accelerometer.SUPPORTED_REPORTS:
-            self.wiimote.accelerometer.handle_report(bytes_read[1:])
-        if rpt_type in Memory.SUPPORTED_REPORTS:
-            self.wiimote.memory.handle_report(bytes_read[1:])
-        if rpt_type in IRCam.SUPPORTED_REPORTS:
-            self.wiimote.ir.handle_report(bytes_read[1:])
 
-    def set_rumble(self, state):
-        self.rumble = state
-        # send any report to toggle rumble bit
-        self._send(self.RPT_STATUS_REQ, int(state))
+class Frame(collections.namedtuple('Frame', 'seq timestamp buttons accel ir')):
+    """
+    Immutable state of a Wiimote after one report, see `WiiMote.snapshot()`.
+    `seq` counts the reports received, `timestamp` is the `time.monotonic()`
+    time of arrival, `buttons` the button bit mask (see `Buttons.BUTTONS`),
+    `accel` the raw (x, y, z) accelerometer values, and `ir` a tuple with
+    an `IRPoint` for every visible IR object.
+    Accelerometer and IR data are only sent by the Wiimote while these
+    sensors are enabled, which `WiiMote.snapshot()` does on its first call.
+    """
+
+    __slots__ = ()
+
+    def pressed(self, button):
+        """
+        Returns True if `button` (e.g. 'A') was pressed.
+        """
+        return bool(self.buttons & Buttons.BUTTONS[button])
+
+
+def _frame_value(source):
+    if type(source) is tuple:  # raw data stored in lazy decoding mode
+        return source[0](source[1], 0)
+    return source
 
 
 class WiiMote(object):
 
     # instance methods
-    def __init__(self, btaddr, model):
+    def __init__(self, btaddr, model, hub=None, sockets=None):
         self.btaddr = btaddr
         self.model = model
         self.connected = False
-        self._com = CommunicationHandler(self)
+        self.dispatcher = None
+        self._own_dispatcher = None  # created by get_dispatcher()
+        self.auto_report_mode = True
+        self._mode_lock = threading.Lock()
+        self._mode_pending = False
+        self._frame = (None, None)  # (published data, Frame built from it)
+        self._com = CommunicationHandler(self, sockets)
         self._leds = LEDs(self)
         self.accelerometer = Accelerometer(self)
         self.buttons = Buttons(self)
@@ -689,17 +3488,175 @@ class WiiMote(object):
         self.speaker = Speaker(self)
         self.memory = Memory(self)
         self.ir = IRCam(self)
+        self.extension = Extension(self)
         """
-        Initializations before this point may not read from memory as
-        this would block forever (until the CommunicationHandler is started).
+        Initializations before this point may not read from or write to memory
+        as this would time out (as the CommunicationHandler is not started yet).
         CommunicationHandler can not be started earlier because the sensors
         would not yet be assigned to variables
         """
-        self._com.start()
+        self._com._init_dispatch()
+        if hub is None:
+            self._com.start()
+        else:
+            self._com.attach(hub)
+        try:
+            self.accelerometer.load_calibration()
+        except (TimeoutError, RuntimeError, ValueError) as e:
+            _debug("Could not load accelerometer calibration: %s" % e)
         self.leds[0] = True  # set first LED to signal successful connection.
 
     def disconnect(self):
-        self._com.running = False
+        self._com.stop()
+        # a dispatcher assigned by the user may be shared with other Wiimotes
+        for sensor in (self.buttons, self.accelerometer, self.ir, self.extension):
+            for callback in list(sensor._callbacks):
+                if isinstance(callback, Subscription):
+                    sensor._callbacks.remove(callback)
+                    callback._dispatcher.unsubscribe(callback)
+        if self.dispatcher is not None and self.dispatcher is self._own_dispatcher:
+            self.dispatcher.shutdown()
+            self.dispatcher = self._own_dispatcher = None
+
+    def get_dispatcher(self):
+        """
+        Returns the `CallbackDispatcher` for callbacks registered with a
+        queueing policy. A dispatcher with two worker threads is created on
+        first use unless one has been assigned to `self.dispatcher` before.
+        An assigned dispatcher can be shared by several Wiimotes; only a
+        dispatcher created here is shut down by `disconnect()`.
+        """
+        if self.dispatcher is None:
+            self.dispatcher = self._own_dispatcher = CallbackDispatcher()
+        return self.dispatcher
+
+    def start_recording(self, path):
+        """
+        Starts appending all received reports to the report log at `path`
+        (see `ReportRecorder`). Use `replay()` to play it back.
+        """
+        self.stop_recording()
+        self._com._recorder = ReportRecorder(path)
+
+    def stop_recording(self):
+        recorder, self._com._recorder = self._com._recorder, None
+        if recorder is not None:
+            recorder.close()
+
+    def enable_output_scheduler(self, max_rate=100.0, window=0.02):
+        """
+        Limits output reports to `max_rate` per second and merges LED and
+        rumble updates made within `window` seconds into a single report
+        (see `OutputScheduler`). Useful for LED animations and rumble patterns.
+        Returns the scheduler.
+        """
+        return self._com.enable_scheduler(max_rate, window)
+
+    def disable_output_scheduler(self):
+        self._com.disable_scheduler()
+
+    def enable_stats(self):
+        """
+        Starts collecting `DeviceStats` for this Wiimote and returns them.
+        Use `stats.snapshot()` to read them and `stats.reset()` to start over.
+        """
+        if self._com.stats is None:
+            self._com.stats = DeviceStats()
+        return self._com.stats
+
+    def disable_stats(self):
+        self._com.stats = None
+
+    def get_stats(self):
+        """
+        Returns the `DeviceStats` of this Wiimote, or None if not enabled.
+        """
+        return self._com.stats
+
+    def set_report_mode(self, mode):
+        """
+        Sets the data reporting mode (0x30 - 0x3f, see WiiBrew) and stops
+        choosing it automatically. Use `None` to choose automatically again.
+        """
+        if mode is None:
+            self.auto_report_mode = True
+        else:
+            self.auto_report_mode = False
+            self._com.set_report_mode(mode)
+        self._update_report_mode()
+
+    def snapshot(self):
+        """
+        Returns the state after the latest report as an immutable `Frame`.
+        Buttons, accelerometer and IR data always come from the same report.
+        Can be called from any thread without locking.
+        Accelerometer and IR are enabled on the first call (see `enable()`),
+        so data only arrives in later frames.
+        """
+        for sensor in (self.accelerometer, self.ir):
+            if not sensor._enabled:
+                _auto_enable(sensor)
+        published, frame = self._frame
+        current = self._com._published
+        if current is None or current is not published:
+            if current is None:  # no report yet
+                current = (0, 0.0, self.buttons._mask, self.accelerometer._state, self.ir._state)
+            seq, timestamp, mask, accel, ir = current
+            frame = Frame(seq, timestamp, mask, tuple(_frame_value(accel)),
+                          tuple(_frame_value(ir)))
+            self._frame = (current, frame)
+        return frame
+
+    def set_lazy_decoding(self, lazy=True):
+        """
+        In lazy decoding mode, the receive thread only keeps a copy of the
+        latest raw accelerometer and IR data. It is decoded when the sensor
+        is read and cached until the next report arrives.
+        Sensors with callbacks or a history are still decoded right away.
+        Buttons are always decoded right away.
+        """
+        self._com.lazy = lazy
+        self._com._init_dispatch()
+
+    def _update_report_mode(self):
+        """
+        Selects the smallest reporting mode that covers all sensors in use
+        and switches the IR camera on or off as needed.
+        Never waits for the lock: if another thread is updating already, it
+        picks up the change before releasing the lock. Otherwise the receive
+        thread could block on a thread that waits for write acknowledgements.
+        """
+        if self._com.lazy:
+            self._com._init_dispatch()
+        self._mode_pending = True
+        while self._mode_pending and self._mode_lock.acquire(blocking=False):
+            try:
+                self._mode_pending = False
+                self._apply_report_mode()
+            finally:
+                self._mode_lock.release()
+
+    def _apply_report_mode(self):
+        ir = self.ir
+        ir_in_use = ir.in_use()
+        mode = self._com.reporting_mode
+        if self.auto_report_mode:
+            mode = select_report_mode(self.accelerometer.in_use(), ir_in_use,
+                                      self.extension.in_use(), ir._mode)
+        data_format = IR_FORMATS.get(mode) if ir_in_use else None
+        if data_format is not None and ir._configured != (data_format, ir._sensitivity):
+            ir._configure(data_format)
+        if mode != self._com.reporting_mode:
+            self._com.set_report_mode(mode)
+        if data_format is None and ir._configured is not None:
+            ir._power_off()
+
+    def get_latency(self):
+        """
+        Returns receive-to-callback latency statistics of this Wiimote.
+        See `LatencyStats`.
+        """
+        return self._com.latency
 
     def _get_capabilities(self):
         return None
@@ -714,7 +3671,7 @@ class WiiMote(object):
         pass
 
     def rumble(self, length=0.5):
-        self.rumbler.rumble(length)
+        return self.rumbler.rumble(length)
 
     def get_leds(self):
         return self._leds
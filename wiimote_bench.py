@@ -0,0 +1,202 @@
+#!/usr/bin/env python3
+
+"""
+Micro-benchmarks for decoding and transport in wiimote.py.
+Runs against a `wiimote.VirtualWiimote`, so no hardware is needed.
+Start as `python3 wiimote_bench.py [-o results.json]` to store the results
+as JSON for comparing releases.
+"""
+
+import argparse
+import json
+import platform
+import sys
+import threading
+import time
+
+import wiimote
+
+# one synthetic report (starting with the report ID) per reporting mode
+IR_EXTENDED = [0x10, 0x20, 0x5a, 0x30, 0x40, 0x5a] + [0xff] * 6
+IR_BASIC = [0x10, 0x20, 0x55, 0x30, 0x40, 0xff, 0xff, 0xff, 0xff, 0xff]
+IR_FULL = [0x10, 0x20, 0x5a, 0x01, 0x02, 0x03, 0x04, 0x00, 0x80] + [0xff] * 9
+REPORTS = {
+    0x30: [0x30, 0x00, 0x08],
+    0x31: [0x31, 0x60, 0x08, 0x80, 0x81, 0x82],
+    0x32: [0x32, 0x00, 0x08] + [0x7f] * 8,
+    0x33: [0x33, 0x60, 0x08, 0x80, 0x81, 0x82] + IR_EXTENDED,
+    0x34: [0x34, 0x00, 0x08] + [0x7f] * 19,
+    0x35: [0x35, 0x60, 0x08, 0x80, 0x81, 0x82] + [0x7f] * 16,
+    0x36: [0x36, 0x00, 0x08] + IR_BASIC + [0x7f] * 9,
+    0x37: [0x37, 0x60, 0x08, 0x80, 0x81, 0x82] + IR_BASIC + [0x7f] * 6,
+    0x3d: [0x3d] + [0x7f] * 21,
+    # interleaved: only decoded as a pair, see INTERLEAVED
+    0x3e: [0x3e, 0x60, 0x08, 0x80] + IR_FULL,
+    0x3f: [0x3f, 0x20, 0x48, 0x81] + IR_FULL,
+}
+INTERLEAVED = (0x3e, 0x3f)
+
+
+def _percentiles(samples):
+    samples = sorted(samples)
+    return {'min': samples[0],
+            'median': samples[len(samples) // 2],
+            'p99': samples[int(len(samples) * 0.99)],
+            'max': samples[-1]}
+
+
+def _report_view(rpt_type):
+    buf = bytearray(32)
+    report = bytes([0xa1] + REPORTS[rpt_type])
+    buf[:len(report)] = report
+    return memoryview(buf)
+
+
+def bench_decode(wm, rpt_types, num_reports):
+    """
+    Decodes `num_reports` reports through CommunicationHandler._handle(),
+    cycling through `rpt_types` (e.g. both halves of an interleaved pair).
+    """
+    views = [_report_view(rpt_type) for rpt_type in rpt_types]
+    handle = wm._com._handle
+    rounds = max(num_reports // len(views), 1)
+    num_reports = rounds * len(views)
+    start = time.perf_counter()
+    for _ in range(rounds):
+        for view in views:
+            handle(view)
+    duration = time.perf_counter() - start
+    latencies = []
+    for _ in range(min(rounds, 10000)):
+        for view in views:
+            t = time.perf_counter()
+            handle(view)
+            latencies.append((time.perf_counter() - t) * 1e6)
+    return {'reports_per_second': num_reports / duration,
+            'latency_us': _percentiles(latencies)}
+
+
+def bench_end_to_end(device, wm, num_reports):
+    """
+    Sends reports through the virtual device's socket one at a time and
+    measures the time until the accelerometer callback has been called.
+    """
+    received = threading.Event()
+    wm.accelerometer.register_callback(lambda state: received.set())
+    wm._com.latency.reset()
+    latencies = []
+    for _ in range(num_reports):
+        received.clear()
+        t = time.perf_counter()
+        device.send_report(REPORTS[0x31])
+        if not received.wait(1.0):
+            raise RuntimeError("Report got lost")
+        latencies.append((time.perf_counter() - t) * 1e6)
+    stats = wm._com.latency
+    return {'send_to_callback_us': _percentiles(latencies),
+            'receive_to_callback_us': {'mean': stats.mean * 1e6, 'min': stats.min * 1e6,
+                                       'max': stats.max * 1e6}}
+
+
+class _NullSocket(object):
+    def send(self, data):
+        return len(data)
+
+
+def bench_send(wm, num_reports):
+    """
+    Measures the cost of encoding output reports in CommunicationHandler.
+    """
+    com = wm._com
+    sendsocket, com._sendsocket = com._sendsocket, _NullSocket()
+    mode = com.reporting_mode
+    data = [0x02] * 9
+    cases = {
+        'leds': lambda: com.send_leds(0x10),
+        'rumble': lambda: com.set_rumble(False),
+        'report_mode': lambda: com.set_report_mode(0x33),
+        'read_request': lambda: com.send_read_request(0x16, 10, True),
+        'write_request': lambda: com.send_write_request(0xb00000, data),
+        'generic': lambda: com._send(0x13, 0x04),
+    }
+    results = {}
+    try:
+        for name, send in cases.items():
+            start = time.perf_counter()
+            for _ in range(num_reports):
+                send()
+            duration = time.perf_counter() - start
+            results[name] = {'reports_per_second': num_reports / duration,
+                             'mean_us': duration / num_reports * 1e6}
+    finally:
+        com._sendsocket = sendsocket
+        com.set_report_mode(mode)
+    return results
+
+
+def bench_batch(num_reports):
+    """
+    Measures vectorized decoding with decode_batch() (requires NumPy).
+    """
+    report = bytes(REPORTS[0x33])
+    buf = report * num_reports
+    start = time.perf_counter()
+    wiimote.decode_batch(buf, len(report))
+    duration = time.perf_counter() - start
+    return {'reports_per_second': num_reports / duration}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmarks for wiimote.py")
+    parser.add_argument('-n', '--num-reports', type=int, default=100000,
+                        help="number of reports per decode benchmark")
+    parser.add_argument('-e', '--num-end-to-end', type=int, default=2000,
+                        help="number of reports for the end-to-end benchmark")
+    parser.add_argument('-o', '--output', help="write results as JSON to this file")
+    args = parser.parse_args()
+
+    device = wiimote.VirtualWiimote()
+    wm = wiimote.connect_virtual(device)
+    results = {
+        'version': '.'.join(str(v) for v in wiimote.VERSION),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'decode': {},
+    }
+    cases = [(rpt_type,) for rpt_type in sorted(REPORTS) if rpt_type not in INTERLEAVED]
+    for rpt_types in cases + [INTERLEAVED]:
+        name = '+'.join('0x%02x' % rpt_type for rpt_type in rpt_types)
+        result = bench_decode(wm, rpt_types, args.num_reports)
+        results['decode'][name] = result
+        print("decode %s: %9.0f reports/s, median %.2f us" %
+              (name, result['reports_per_second'], result['latency_us']['median']))
+    results['decode_lazy'] = {}
+    wm.set_lazy_decoding()
+    for rpt_type in (0x31, 0x33, 0x37):
+        result = bench_decode(wm, (rpt_type,), args.num_reports)
+        results['decode_lazy']['0x%02x' % rpt_type] = result
+        print("decode 0x%02x (lazy): %9.0f reports/s, median %.2f us" %
+              (rpt_type, result['reports_per_second'], result['latency_us']['median']))
+    wm.set_lazy_decoding(False)
+    results['send'] = bench_send(wm, args.num_reports)
+    for name, result in results['send'].items():
+        print("send %s: %9.0f reports/s, mean %.2f us" %
+              (name, result['reports_per_second'], result['mean_us']))
+    results['end_to_end'] = bench_end_to_end(device, wm, args.num_end_to_end)
+    print("end to end: median %.1f us, p99 %.1f us" %
+          (results['end_to_end']['send_to_callback_us']['median'],
+           results['end_to_end']['send_to_callback_us']['p99']))
+    if wiimote.np is not None:
+        results['decode_batch'] = bench_batch(args.num_reports)
+        print("decode_batch 0x33: %9.0f reports/s" % results['decode_batch']['reports_per_second'])
+    wm.disconnect()
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(results, f, indent=2)
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
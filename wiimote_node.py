@@ -14,14 +14,19 @@ import wiimote
 
 class BufferNode(CtrlNode):
     """
-    Buffers the last n samples provided on input and provides them as a list of
-    length n on output.
+    Buffers the last n samples provided on input and provides them as an array of
+    length n on output (shorter until n samples have arrived).
+    Input may be a single sample or an array with any number of samples.
     A spinbox widget allows for setting the size of the buffer.
     Default size is 32 samples.
+
+    Samples are stored twice in a preallocated circular buffer of 2n entries,
+    so the last n samples are always contiguous and the output is a view
+    into the buffer instead of a copy. Downstream nodes must not modify it.
     """
     nodeName = "Buffer"
     uiTemplate = [
-        ('size',  'spin', {'value': 32.0, 'step': 1.0, 'bounds': [0.0, 128.0]}),
+        ('size',  'spin', {'value': 32.0, 'step': 1.0, 'bounds': [1.0, 100000.0]}),
     ]
 
     def __init__(self, name):
@@ -29,15 +34,49 @@ class BufferNode(CtrlNode):
             'dataIn': dict(io='in'),
             'dataOut': dict(io='out'),
         }
-        self._buffer = np.array([])
+        self._size = 0
+        self._buffer = np.zeros(0)
+        self._pos = 0  # next write position in the first half
+        self._count = 0  # number of valid samples
         CtrlNode.__init__(self, name, terminals=terminals)
 
+    def _resize(self, size):
+        """
+        Reallocates the buffer, keeping the latest samples that still fit.
+        """
+        latest = self._latest()[-size:].copy()
+        self._size = size
+        self._buffer = np.zeros(2 * size)
+        self._pos = 0
+        self._count = 0
+        self._write(latest)
+
+    def _write(self, values):
+        size = self._size
+        values = values[-size:]
+        num = len(values)
+        pos = self._pos
+        first = min(num, size - pos)
+        self._buffer[pos:pos + first] = values[:first]
+        self._buffer[pos + size:pos + size + first] = values[:first]
+        rest = num - first
+        if rest:  # wrap around
+            self._buffer[:rest] = values[first:]
+            self._buffer[size:size + rest] = values[first:]
+        self._pos = (pos + num) % size
+        self._count = min(self._count + num, size)
+
+    def _latest(self):
+        end = self._pos + self._size
+        return self._buffer[end - self._count:end]
+
     def process(self, **kwds):
         size = int(self.ctrls['size'].value())
-        self._buffer = np.append(self._buffer, kwds['dataIn'])
-        self._buffer = self._buffer[-size:]
-        output = self._buffer
-        return {'dataOut': output}
+        if size != self._size:
+            self._resize(size)
+        if kwds['dataIn'] is not None:
+            self._write(np.asarray(kwds['dataIn'], dtype=np.float64).ravel())
+        return {'dataOut': self._latest()}
 
 fclib.registerNodeType(BufferNode, [('Data',)])
 
@@ -49,7 +88,9 @@ class WiimoteNode(Node):
     Supported sensors: accelerometer (3 axis)
     Text input box allows for setting a Bluetooth MAC address.
     Pressing the "connect" button tries connecting to the Wiimote.
-    Update rate can be changed via a spinbox widget. Setting it to "0"
+    Update rate can be changed via a spinbox widget. With update rates
+    above "0", all samples received since the last update are output as
+    one batch (from the accelerometer's history). Setting it to "0"
     activates callbacks every time a new sensor value arrives (which is
     quite often -> performance hit)
     """
@@ -63,7 +104,8 @@ class WiimoteNode(Node):
             'accelZ': dict(io='out'),
         }
         self.wiimote = None
-        self._acc_vals = []
+        self._acc_vals = np.zeros((1, 3))
+        self._history_seq = 0
 
         # Configuration UI
         self.ui = QtGui.QWidget()
@@ -102,12 +144,16 @@ class WiimoteNode(Node):
     def update_all_sensors(self):
         if self.wiimote is None:
             return
-        self._acc_vals = self.wiimote.accelerometer
+        history = self.wiimote.accelerometer.history
+        self._history_seq, _, values = history.since(self._history_seq)
+        if len(values) == 0:
+            return
+        self._acc_vals = values
         # todo: other sensors...
         self.update()
 
     def update_accel(self, acc_vals):
-        self._acc_vals = acc_vals
+        self._acc_vals = np.array([acc_vals])
         self.update()
 
     def ctrlWidget(self):
@@ -127,9 +173,13 @@ class WiimoteNode(Node):
                 self.connect_button.setText("try again")
             else:
                 self.connect_button.setText("disconnect")
+                self.wiimote.accelerometer.enable_history(4096)
+                self._history_seq = 0
                 self.set_update_rate(self.update_rate_input.value())
 
     def set_update_rate(self, rate):
+        if self.wiimote is None:  # applied on connect
+            return
         if rate == 0:  # use callbacks for max. update rate
             self.update_timer.stop()
             self.wiimote.accelerometer.register_callback(self.update_accel)
@@ -138,8 +188,8 @@ class WiimoteNode(Node):
             self.update_timer.start(1000.0/rate)
 
     def process(self, **kwdargs):
-        x, y, z = self._acc_vals
-        return {'accelX': np.array([x]), 'accelY': np.array([y]), 'accelZ': np.array([z])}
+        vals = self._acc_vals
+        return {'accelX': vals[:, 0], 'accelY': vals[:, 1], 'accelZ': vals[:, 2]}
 
 fclib.registerNodeType(WiimoteNode, [('Sensor',)])
 